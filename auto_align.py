@@ -0,0 +1,339 @@
+#!/usr/bin/env python
+
+# Copyright 2016 Ian Munsie
+#
+# This file is part of the Stereo Cropping Tool.
+#
+# The Stereo Cropping Tool is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The Stereo Cropping Tool is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# The Stereo Cropping Tool. If not, see <http://www.gnu.org/licenses/>.
+
+# Estimates a starting parallax and vertical alignment for a stereo image.
+#
+# The parallax is found by phase correlation of reduced size copies of the two
+# eyes, which finds the horizontal shift that lines up most of the image, and
+# proposes the parallax that places that part of the scene at the screen.
+#
+# The vertical alignment is found by correlating the average vertical
+# gradient of each row of the two eyes, which is unaffected by the horizontal
+# differences between the eyes, coarse to fine so that only a few shifts have
+# to be tried at the full number of rows.
+#
+# The batch mode saves the estimates to a new .spct file for every image in a
+# shoot that has not been adjusted yet:
+#
+#   python auto_align.py [-j JOBS] [-n] DIRECTORY...
+
+from __future__ import print_function
+
+import sys, os, time
+import argparse, itertools, multiprocessing
+
+import numpy as np
+from PIL import Image
+
+import stereo_image
+import navigation
+
+# Width the eyes are reduced to before correlating them. One pixel at this
+# width is 0.2% parallax, and the peak is located to a fraction of that:
+analysis_width = 512
+
+# Shifts larger than these fractions of the image size are not considered,
+# which also keeps the edges of the correlation (where shifts wrap around)
+# out of the search:
+max_horizontal_shift = 0.25
+max_vertical_shift = 0.1
+
+# Estimates with a correlation peak lower than this are too unreliable to be
+# used, e.g. for featureless images or eyes that don't overlap much:
+min_confidence = 0.05
+
+# The vertical alignment is estimated from the eyes reduced to this many rows
+# (one row is 0.1% of the height, and the peak is located to a fraction of
+# that), and this many columns. Fewer columns are quicker, but average out
+# less of the detail that differs between the eyes:
+profile_rows = 1024
+profile_columns = 512
+
+# Profiles are halved until they are no more than this many rows, where every
+# shift up to max_vertical_shift is tried:
+coarsest_profile_rows = 64
+
+# Below this normalised correlation the rows of the eyes don't match well
+# enough to trust, e.g. for images without much horizontal detail. Unrelated
+# images score around 0.1:
+min_vertical_confidence = 0.3
+
+def reduce_eye(eye, width=analysis_width):
+    '''
+    Returns a greyscale float32 array of one eye, reduced to width pixels
+    wide if it is larger than that.
+    '''
+    w, h = eye.size
+    if w > width:
+        height = max(1, int(round(h * float(width) / w)))
+        if w > width * 2:
+            # Averaging every pixel of a 24MP image is several times slower
+            # than the rest of the estimate put together, and averaging every
+            # other pixel in each direction is still plenty to avoid aliasing:
+            eye = eye.resize((width * 2, height * 2), Image.NEAREST)
+        eye = eye.resize((width, height), Image.BOX)
+    return np.asarray(eye.convert('L'), np.float32)
+
+def phase_correlation(a, b):
+    '''
+    Returns the phase correlation surface of two equally sized arrays, which
+    peaks at the (wrapped around) (dy, dx) that b is shifted by relative to
+    a. The surface sums to 1, so the height of the peak is the fraction of
+    the images that agree on that shift.
+    '''
+    # Window the images so their edges don't correlate with each other:
+    window = np.outer(np.hanning(a.shape[0]), np.hanning(a.shape[1])).astype(np.float32)
+    fa = np.fft.rfft2((a - a.mean()) * window)
+    fb = np.fft.rfft2((b - b.mean()) * window)
+    cross = fb * fa.conj()
+    cross /= np.maximum(np.abs(cross), 1e-9)
+    return np.fft.irfft2(cross, a.shape)
+
+def subpixel_peak(values, i):
+    # Fits a parabola through the peak and its neighbours:
+    l, c, r = values[i - 1], values[i], values[(i + 1) % len(values)]
+    denominator = l - 2.0 * c + r
+    if denominator >= 0:
+        return float(i)
+    return i + 0.5 * (l - r) / denominator
+
+def shift_profile(surface, max_dy, max_dx):
+    '''
+    Returns the strongest correlation for each horizontal shift from -max_dx
+    to max_dx, over vertical shifts up to max_dy, and the vertical shift it
+    was found at.
+    '''
+    rows = np.r_[0:max_dy + 1, surface.shape[0] - max_dy:surface.shape[0]]
+    columns = np.r_[surface.shape[1] - max_dx:surface.shape[1], 0:max_dx + 1]
+    band = surface[rows][:, columns]
+    best = band.argmax(axis=0)
+    dy = np.where(rows[best] > surface.shape[0] // 2, rows[best] - surface.shape[0], rows[best])
+    return band[best, np.arange(band.shape[1])], dy
+
+def reduce_eye_rows(eye, rows=profile_rows, columns=profile_columns):
+    # Like reduce_eye(), but keeping more rows than the aspect ratio would:
+    w, h = eye.size
+    rows = min(rows, h)
+    columns = min(columns, w)
+    if w > columns * 2 and h > rows * 2:
+        eye = eye.resize((columns * 2, rows * 2), Image.NEAREST)
+    eye = eye.resize((columns, rows), Image.BOX)
+    return np.asarray(eye.convert('L'), np.float32)
+
+def row_profile(eye):
+    '''
+    Returns the vertical gradient of the average of each row of an eye. The
+    sides of the image are left out, as they may only be visible in one eye.
+    '''
+    grey = reduce_eye_rows(eye)
+    margin = grey.shape[1] // 10
+    return np.diff(grey[:, margin : grey.shape[1] - margin].mean(axis=1))
+
+def profile_correlation(a, b, shifts, margin):
+    '''
+    Returns the normalised correlation of a with b shifted by each of shifts,
+    all at once. Rows within margin of either end are left out of a, so that
+    each shift is compared over the same rows.
+    '''
+    n = len(a) - 2 * margin
+    window = a[margin : margin + n]
+    window = window - window.mean()
+    shifted = b[margin + shifts[:, np.newaxis] + np.arange(n)[np.newaxis, :]]
+    shifted = shifted - shifted.mean(axis=1)[:, np.newaxis]
+    numerator = (shifted * window).sum(axis=1)
+    denominator = np.sqrt((shifted * shifted).sum(axis=1) * (window * window).sum())
+    return numerator / np.maximum(denominator, 1e-9)
+
+def estimate_vertical_alignment(eyes):
+    '''
+    Estimates the vertical alignment to line up the rows of the two eyes of a
+    stereo image, in the same units as Adjustments.vertical_alignment. eyes
+    are the left and right eye images, at any resolution. Returns the
+    vertical alignment and a confidence from 0 to 1, which is below
+    min_vertical_confidence if the estimate should not be used.
+    '''
+    pyramid = [ (row_profile(eyes[0]), row_profile(eyes[1])) ]
+    while len(pyramid[-1][0]) > coarsest_profile_rows:
+        pyramid.append(tuple(p[: len(p) // 2 * 2].reshape(-1, 2).mean(axis=1) for p in pyramid[-1]))
+
+    # Try every shift at the coarsest level, then only the shifts either side
+    # of the previous estimate at each finer level:
+    a, b = pyramid[-1]
+    max_dy = max(1, int(len(a) * max_vertical_shift))
+    shifts = np.arange(-max_dy, max_dy + 1)
+    correlation = profile_correlation(a, b, shifts, max_dy)
+    dy = shifts[correlation.argmax()]
+    for a, b in reversed(pyramid[:-1]):
+        margin = max(2, int(len(a) * max_vertical_shift))
+        shifts = np.clip(np.arange(2 * dy - 2, 2 * dy + 3), -margin, margin)
+        correlation = profile_correlation(a, b, shifts, margin)
+        dy = shifts[correlation.argmax()]
+
+    i = int(correlation.argmax())
+    confidence = max(0.0, float(correlation[i]))
+    if 0 < i < len(correlation) - 1:
+        dy = shifts[0] + subpixel_peak(correlation, i)
+
+    # A row y of the left eye is row y + dy of the right eye, which the
+    # vertical alignment cancels out by cropping the right eye that much
+    # lower (as a fraction of the height):
+    return float(dy) / len(pyramid[0][0]), confidence
+
+def estimate_parallax(eyes):
+    '''
+    Estimates the parallax to place the dominant plane of a stereo image at
+    the screen, in the same units as Adjustments.parallax. eyes are the left
+    and right eye images, at any resolution. Returns the parallax and a
+    confidence from 0 to 1, which is below min_confidence if the estimate
+    should not be used.
+    '''
+    left = reduce_eye(eyes[0])
+    right = reduce_eye(eyes[1])
+    height, width = left.shape
+    surface = phase_correlation(left, right)
+
+    max_dx = max(1, int(width * max_horizontal_shift))
+    max_dy = max(1, int(height * max_vertical_shift))
+    profile, dy = shift_profile(surface, max_dy, max_dx)
+    i = int(profile.argmax())
+    confidence = float(profile[i])
+    if 0 < i < len(profile) - 1:
+        dx = subpixel_peak(profile, i) - max_dx
+    else:
+        dx = float(i - max_dx)
+
+    # A point x pixels across the left eye is at x + dx in the right eye.
+    # Adjustments.parallax moves the eyes apart by parallax percent of the
+    # width, which places that point at the screen when it cancels out dx:
+    return -100.0 * dx / width, confidence
+
+def estimate_adjustments(eyes):
+    '''
+    Returns Adjustments with the estimated parallax and vertical alignment,
+    where they are reliable, and the confidence of each estimate.
+    '''
+    parallax, parallax_confidence = estimate_parallax(eyes)
+    vertical_alignment, vertical_confidence = estimate_vertical_alignment(eyes)
+    adj = stereo_image.Adjustments()
+    if parallax_confidence >= min_confidence:
+        adj.parallax = parallax
+    if vertical_confidence >= min_vertical_confidence:
+        adj.vertical_alignment = vertical_alignment
+    return adj, parallax_confidence, vertical_confidence
+
+def describe_estimate(adj, parallax_confidence, vertical_confidence):
+    def describe(name, value, fmt, confidence, threshold):
+        if confidence < threshold:
+            return '%s unreliable (confidence %.3f)' % (name, confidence)
+        return ('%s ' + fmt + ' (confidence %.3f)') % (name, value, confidence)
+    return '%s, %s' % (
+            describe('Parallax', adj.parallax, '%.2f', parallax_confidence, min_confidence),
+            describe('vertical alignment', adj.vertical_alignment, '%.4f', vertical_confidence, min_vertical_confidence))
+
+def load_eyes_for_estimate(filename):
+    # JPEG based images can be decoded at a reduced scale, which is many
+    # times faster. The scale is chosen to keep enough columns for the
+    # parallax and enough rows for the vertical alignment:
+    eye_size = stereo_image.get_eye_size(filename)
+    draft_size = (max(analysis_width * 2, eye_size[0] * profile_rows // 2 // eye_size[1]),
+            max(profile_rows // 2, eye_size[1] * analysis_width * 2 // eye_size[0]))
+    return stereo_image.decode_stereo_image(filename, draft_size)
+
+def estimate_worker(filename):
+    # Runs in the worker processes, so must not raise:
+    try:
+        return filename, estimate_adjustments(load_eyes_for_estimate(filename)), None
+    except (IOError, OSError, ValueError, stereo_image.UnsupportedImageError) as e:
+        return filename, None, str(e)
+    except Exception as e:
+        # Anything else is a bug, but should only lose the estimate of this
+        # file rather than the whole run:
+        return filename, None, '%s: %s' % (e.__class__.__name__, str(e))
+
+def save_estimate(filename, adj):
+    '''
+    Saves a new .spct file for an image with the estimated adjustments. There
+    is no image saved alongside it until it is exported, e.g. by
+    batch_export.py.
+    '''
+    dirname = os.path.dirname(filename)
+    prefix = navigation.file_prefix(filename)
+    base_filename = os.path.join(dirname, prefix) + '-cropped'
+    i = navigation.next_cropped_index(os.listdir(dirname or os.curdir), prefix)
+    while True:
+        spct_filename = base_filename + ('-%d' % i if i else '') + '.spct'
+        if stereo_image.claim_file(spct_filename):
+            break
+        i += 1
+    stereo_image.save_spct(spct_filename, filename, adj)
+    return spct_filename
+
+def parse_args():
+    parser = argparse.ArgumentParser(description = 'Estimate the parallax and '
+            'vertical alignment of every stereo image that has not been '
+            'adjusted yet, and save them to a new .spct file')
+    parser.add_argument('directories', nargs='+', metavar='directory')
+    parser.add_argument('-j', '--jobs', type=int, default=multiprocessing.cpu_count(),
+            help='Number of images to estimate in parallel (default: %(default)s)')
+    parser.add_argument('-n', '--dry-run', action='store_true',
+            help='Only print the estimates, without saving anything')
+    return parser.parse_args()
+
+def main():
+    multiprocessing.freeze_support()
+    args = parse_args()
+
+    files = list(itertools.chain(*map(navigation.find_unadjusted_images, args.directories)))
+    if args.jobs > 1 and len(files) > 1:
+        pool = multiprocessing.Pool(args.jobs)
+        results = pool.imap_unordered(estimate_worker, files)
+    else:
+        pool = None
+        results = itertools.imap(estimate_worker, files)
+
+    saved = skipped = failed = 0
+    start = time.time()
+    for i, (filename, estimate, error) in enumerate(results, 1):
+        if error is not None:
+            print('[%i/%i] Unable to estimate %s: %s' % (i, len(files), filename, error), file=sys.stderr)
+            failed += 1
+            continue
+        adj, parallax_confidence, vertical_confidence = estimate
+        description = describe_estimate(*estimate)
+        if parallax_confidence < min_confidence and vertical_confidence < min_vertical_confidence:
+            print('[%i/%i] %s: %s' % (i, len(files), filename, description))
+            skipped += 1
+            continue
+        if not args.dry_run:
+            filename = save_estimate(filename, adj)
+        print('[%i/%i] %s: %s' % (i, len(files), filename, description))
+        saved += 1
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    print('%i estimated, %i unreliable, %i failed in %.1f seconds' % (saved, skipped, failed, time.time() - start))
+    if failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
+
+# vi:et:sw=4:ts=4
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+
+# Copyright 2016 Ian Munsie
+#
+# This file is part of the Stereo Cropping Tool.
+#
+# The Stereo Cropping Tool is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The Stereo Cropping Tool is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# The Stereo Cropping Tool. If not, see <http://www.gnu.org/licenses/>.
+
+# Headless exporter that applies the adjustments saved in .spct files to their
+# source images without opening a window, e.g. to re-export a whole shoot after
+# the source images have been modified in rawtherapee.
+
+from __future__ import print_function
+
+import sys, os, time, sqlite3
+import argparse, itertools, multiprocessing
+
+import stereo_image
+import navigation
+import export_profiles
+import catalog
+import spct
+import export_record
+
+# Recycle worker processes periodically so that any memory fragmentation from
+# decoding large images does not accumulate over a long run:
+max_tasks_per_worker = 50
+
+class STATUS:
+    EXPORTED = 'Exported'
+    SKIPPED = 'Up to date'
+    FAILED = 'Failed'
+
+def output_up_to_date(spct_filename, document, adj, lossless):
+    output = stereo_image.paired_output(spct_filename, document.source)
+    if document.export is not None:
+        profile = export_profiles.get_profile(adj.export_profile)
+        return export_record.is_current(document.export, document.source, adj, profile, lossless, output)
+
+    # .spct files saved by older versions have no export record. The .spct
+    # was saved before the image alongside it, so the output is considered up
+    # to date if it is newer than both the .spct and the source image, and
+    # the adjustments have not been overridden:
+    if adj.export_profile != document.export_profile:
+        return False
+    try:
+        output_mtime = os.stat(output).st_mtime
+    except OSError:
+        return False
+    return output_mtime >= max(os.stat(spct_filename).st_mtime, os.stat(document.source).st_mtime)
+
+def export_spct(spct_filename, document=None, force=True, lossless=True, profile=None):
+    '''
+    Exports the image saved alongside a .spct file again, overwriting it and
+    the .spct file in place, unless it is already up to date.
+    '''
+    if document is None:
+        document = spct.SpctDocument.load(spct_filename)
+    adj = document.adjustments()
+    if profile is not None:
+        adj.export_profile = profile
+    if not force and output_up_to_date(spct_filename, document, adj, lossless):
+        record = document.export and export_record.refreshed(document.export, document.source)
+        if record is not None:
+            document.export = record
+            document.save(spct_filename)
+        return STATUS.SKIPPED
+    stereo_image.save_adjusted_image(None, document.source, adj, lossless,
+            spct_filename=spct_filename, previous_export=document.export)
+    return STATUS.EXPORTED
+
+def export_worker(args):
+    # Runs in the worker processes, so must not raise - any failure is passed
+    # back to be reported by the parent process.
+    spct_filename, document, force, lossless, profile = args
+    try:
+        return spct_filename, export_spct(spct_filename, document, force, lossless, profile), None
+    except (IOError, OSError, ValueError, KeyError,
+            stereo_image.SpctError, stereo_image.UnsupportedImageError) as e:
+        return spct_filename, STATUS.FAILED, str(e)
+    except Exception as e:
+        # Anything else is a bug, but should only fail this file rather than
+        # the whole export:
+        return spct_filename, STATUS.FAILED, '%s: %s' % (e.__class__.__name__, str(e))
+
+def init_worker(cache_size):
+    # Each worker has its own cache of decoded images, which is disabled by
+    # default as most exports use a different source image:
+    stereo_image.eye_cache.max_bytes = cache_size
+
+def find_files(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for filename in navigation.find_spct_files(path):
+                yield filename
+        else:
+            yield path
+
+def parse_args():
+    parser = argparse.ArgumentParser(description = 'Apply the adjustments '
+            'saved in .spct files to their source images and save the results')
+    parser.add_argument('files', nargs='*', metavar='path',
+            help='Stereo Photo Cropping Tool files to export, or directories '
+            'to search for the most recent .spct file of each image')
+    parser.add_argument('--where', metavar='CONDITION',
+            help='Export the .spct files in the catalog matching an SQL '
+            'condition, e.g. "parallax > 2" (see catalog.py)')
+    parser.add_argument('-j', '--jobs', type=int, default=multiprocessing.cpu_count(),
+            help='Number of images to export in parallel (default: %(default)s)')
+    parser.add_argument('-f', '--force', action='store_true',
+            help='Export images even if the output is already up to date')
+    parser.add_argument('--profile', metavar='NAME',
+            help='Export profile to use instead of the one saved in each '
+            '.spct file, e.g. proof or master')
+    parser.add_argument('--reencode', action='store_true',
+            help='Always decode and re-encode images, rather than cropping '
+            'JPEGs losslessly with jpegtran where possible')
+    parser.add_argument('--cache-size', type=int, default=0, metavar='MB',
+            help='Size of the decoded image cache of each process, useful if '
+            'several .spct files share the same source image (default: %(default)s)')
+    args = parser.parse_args()
+    if not args.files and args.where is None:
+        parser.error('No files to export')
+    if args.where is not None and catalog.open_catalog() is None:
+        parser.error('--where needs a catalog, create one with: catalog.py scan DIRECTORY...')
+    if args.profile is not None and args.profile not in export_profiles.profile_names():
+        parser.error('No export profile named %s, choose from: %s' % (args.profile,
+            ', '.join(export_profiles.profile_names())))
+    return args
+
+def main():
+    multiprocessing.freeze_support()
+    args = parse_args()
+
+    files = list(find_files(args.files))
+    if args.where is not None:
+        db = catalog.open_catalog()
+        try:
+            files.extend(db.query(args.where))
+        except sqlite3.Error as e:
+            print('Invalid --where condition: %s' % str(e), file=sys.stderr)
+            sys.exit(1)
+        finally:
+            db.close()
+
+    # Read every .spct file up front with a pool of threads, so that any that
+    # are invalid are reported straight away and the workers don't have to:
+    counts = dict.fromkeys((STATUS.EXPORTED, STATUS.SKIPPED, STATUS.FAILED), 0)
+    tasks = []
+    for filename, document, error in spct.load_many(files):
+        if error is not None:
+            counts[STATUS.FAILED] += 1
+            print('[%i/%i] Unable to export %s: %s' % (counts[STATUS.FAILED], len(files), filename, error), file=sys.stderr)
+        else:
+            tasks.append((filename, document, args.force, not args.reencode, args.profile))
+
+    cache_size = args.cache_size * 1024 * 1024
+    if args.jobs > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(args.jobs, init_worker, (cache_size,),
+                maxtasksperchild=max_tasks_per_worker)
+        results = pool.imap_unordered(export_worker, tasks)
+    else:
+        pool = None
+        init_worker(cache_size)
+        results = itertools.imap(export_worker, tasks)
+
+    start = time.time()
+    for i, (filename, status, error) in enumerate(results, counts[STATUS.FAILED] + 1):
+        counts[status] += 1
+        rate = counts[STATUS.EXPORTED] / max(time.time() - start, 1e-6)
+        if error is not None:
+            print('[%i/%i] Unable to export %s: %s' % (i, len(files), filename, error), file=sys.stderr)
+        else:
+            print('[%i/%i] %s: %s (%.2f images/s)' % (i, len(files), status, filename, rate))
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    print('%i exported, %i up to date, %i failed in %.1f seconds' % (counts[STATUS.EXPORTED],
+        counts[STATUS.SKIPPED], counts[STATUS.FAILED], time.time() - start))
+    if counts[STATUS.FAILED]:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
+
+# vi:et:sw=4:ts=4
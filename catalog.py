@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+
+# Copyright 2016 Ian Munsie
+#
+# This file is part of the Stereo Cropping Tool.
+#
+# The Stereo Cropping Tool is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The Stereo Cropping Tool is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# The Stereo Cropping Tool. If not, see <http://www.gnu.org/licenses/>.
+
+# An optional SQLite catalog of the adjustments in every .spct file, so that
+# questions like "which images have more than 2% parallax" or "which crops
+# were made from this MPO" don't require opening thousands of files. The
+# catalog is only used once it has been created by scanning some directories:
+#
+#   python catalog.py scan [-j THREADS] DIRECTORY...
+#   python catalog.py query "parallax > 2"
+#   python catalog.py source IMG_0001.MPO
+#
+# after which every .spct saved by the tool or batch_export.py is added to it.
+
+from __future__ import print_function
+
+import sys, os, time, sqlite3
+import argparse, itertools
+
+import stereo_image
+import spct
+
+catalog_filename = os.path.join(os.path.expanduser('~'), '.stereo_cropper_catalog.sqlite')
+
+schema = '''
+CREATE TABLE IF NOT EXISTS spct (
+    path TEXT PRIMARY KEY,
+    source TEXT NOT NULL,
+    output TEXT,
+    parallax REAL NOT NULL,
+    vertical_alignment REAL NOT NULL,
+    vcrop_top REAL NOT NULL,
+    vcrop_bottom REAL NOT NULL,
+    hcrop_left_l REAL NOT NULL,
+    hcrop_right_l REAL NOT NULL,
+    hcrop_left_r REAL NOT NULL,
+    hcrop_right_r REAL NOT NULL,
+    background INTEGER NOT NULL,
+    export_profile TEXT,
+    spct_mtime REAL NOT NULL,
+    source_mtime REAL
+);
+CREATE INDEX IF NOT EXISTS spct_source ON spct (source);
+CREATE INDEX IF NOT EXISTS spct_parallax ON spct (parallax);
+'''
+
+columns = ('path', 'source', 'output', 'parallax', 'vertical_alignment',
+        'vcrop_top', 'vcrop_bottom', 'hcrop_left_l', 'hcrop_right_l',
+        'hcrop_left_r', 'hcrop_right_r', 'background', 'export_profile',
+        'spct_mtime', 'source_mtime')
+
+def mtime(filename):
+    try:
+        return os.stat(filename).st_mtime
+    except OSError:
+        return None
+
+def spct_row(spct_filename, source, adj):
+    spct_filename = os.path.abspath(spct_filename)
+    source = os.path.abspath(source)
+    output = stereo_image.paired_output(spct_filename, source)
+    if not os.path.exists(output):
+        output = None
+    return (spct_filename, source, output, adj.parallax, adj.vertical_alignment,
+            adj.vcrop[0], adj.vcrop[1], adj.hcrop[0][0], adj.hcrop[0][1],
+            adj.hcrop[1][0], adj.hcrop[1][1], adj.background, adj.export_profile,
+            os.stat(spct_filename).st_mtime, mtime(source))
+
+def find_all_spct_files(top):
+    # Every .spct file, not just the most recent of each image:
+    for dirpath, dirnames, filenames in os.walk(top):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if os.path.splitext(filename)[1].lower() == '.spct':
+                yield os.path.join(dirpath, filename)
+
+class Catalog(object):
+    def __init__(self, filename=catalog_filename):
+        self.filename = filename
+        # Several batch export processes may be saving at once:
+        self.db = sqlite3.connect(filename, timeout=60)
+        self.db.executescript(schema)
+
+    def close(self):
+        self.db.close()
+
+    def add(self, spct_filename, source, adj):
+        '''
+        Adds or updates a .spct file in the catalog.
+        '''
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO spct VALUES (%s)' % ', '.join('?' * len(columns)),
+                    spct_row(spct_filename, source, adj))
+
+    def scan(self, paths, threads=None):
+        '''
+        Adds every .spct file found under the given directories, loading them
+        on a pool of threads, and removes any in the catalog under those directories
+        that no longer exist. Returns the number of files added and a list of
+        (filename, error) for any that couldn't be loaded.
+        '''
+        paths = [ os.path.abspath(path) for path in paths ]
+        files = list(itertools.chain(*map(find_all_spct_files, paths)))
+
+        found = set()
+        failed = []
+        with self.db:
+            for filename, document, error in spct.load_many(files, threads):
+                if error is None:
+                    try:
+                        row = spct_row(filename, document.source, document.adjustments())
+                    except OSError as e:
+                        error = str(e)
+                if error is not None:
+                    failed.append((filename, error))
+                    continue
+                found.add(row[0])
+                self.db.execute('INSERT OR REPLACE INTO spct VALUES (%s)' % ', '.join('?' * len(columns)), row)
+
+            for path in paths:
+                prefix = os.path.join(path, '')
+                for (spct_filename,) in self.db.execute('SELECT path FROM spct WHERE substr(path, 1, ?) = ?',
+                        (len(prefix), prefix)).fetchall():
+                    if spct_filename not in found:
+                        self.db.execute('DELETE FROM spct WHERE path = ?', (spct_filename,))
+        return len(found), failed
+
+    def query(self, where='1', params=()):
+        '''
+        Returns the .spct filenames matching an SQL condition on the columns
+        of the catalog, e.g. query('parallax > ?', (2.0,)).
+        '''
+        return [ path for (path,) in
+                self.db.execute('SELECT path FROM spct WHERE %s ORDER BY path' % where, params) ]
+
+    def derived_from(self, source):
+        '''
+        Returns the .spct filenames of every crop of a source image.
+        '''
+        return self.query('source = ?', (os.path.abspath(source),))
+
+def open_catalog():
+    '''
+    Returns the catalog if one has been created, or None.
+    '''
+    if not os.path.exists(catalog_filename):
+        return None
+    return Catalog(catalog_filename)
+
+def record_saved(spct_filename, source, adj):
+    '''
+    Adds a newly saved .spct file to the catalog if there is one. Failures are
+    reported but are not fatal, as the catalog can always be rebuilt.
+    '''
+    try:
+        catalog = open_catalog()
+        if catalog is not None:
+            try:
+                catalog.add(spct_filename, source, adj)
+            finally:
+                catalog.close()
+    except (sqlite3.Error, OSError) as e:
+        print('Unable to add %s to the catalog: %s' % (spct_filename, str(e)))
+
+def parse_args():
+    parser = argparse.ArgumentParser(description = 'Maintain and search the '
+            'catalog of .spct files in %s' % catalog_filename)
+    subparsers = parser.add_subparsers(dest='command')
+
+    scan = subparsers.add_parser('scan', help='Add every .spct file in some '
+            'directories to the catalog, creating it if necessary')
+    scan.add_argument('directories', nargs='+', metavar='directory')
+    scan.add_argument('-j', '--threads', type=int, default=spct.default_threads,
+            help='Number of .spct files to read at once (default: %(default)s)')
+
+    query = subparsers.add_parser('query', help='List the .spct files matching '
+            'an SQL condition on the columns: %s' % ', '.join(columns))
+    query.add_argument('where')
+
+    source = subparsers.add_parser('source', help='List the .spct files saved '
+            'from a source image')
+    source.add_argument('source')
+
+    args = parser.parse_args()
+    # Only scanning creates the catalog, since every save is recorded once
+    # it exists:
+    if args.command != 'scan' and not os.path.exists(catalog_filename):
+        parser.error('No catalog to search, create one with: catalog.py scan DIRECTORY...')
+    return args
+
+def main():
+    args = parse_args()
+    if args.command == 'scan':
+        catalog = Catalog()
+    else:
+        catalog = open_catalog()
+    try:
+        if args.command == 'scan':
+            start = time.time()
+            added, failed = catalog.scan(args.directories, args.threads)
+            for filename, error in failed:
+                print('Unable to load %s: %s' % (filename, error), file=sys.stderr)
+            print('%i .spct files catalogued, %i failed in %.1f seconds' %
+                    (added, len(failed), time.time() - start))
+        elif args.command == 'query':
+            for filename in catalog.query(args.where):
+                print(filename)
+        elif args.command == 'source':
+            for filename in catalog.derived_from(args.source):
+                print(filename)
+    except sqlite3.Error as e:
+        print('Catalog error: %s' % str(e), file=sys.stderr)
+        sys.exit(1)
+    finally:
+        catalog.close()
+
+if __name__ == '__main__':
+    main()
+
+# vi:et:sw=4:ts=4
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+
+# Copyright 2016 Ian Munsie
+#
+# This file is part of the Stereo Cropping Tool.
+#
+# The Stereo Cropping Tool is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The Stereo Cropping Tool is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# The Stereo Cropping Tool. If not, see <http://www.gnu.org/licenses/>.
+
+# Reports the depth of every image in a shoot with the adjustments in its
+# .spct file applied, to find the images that will be uncomfortable to view
+# before printing or projecting them:
+#
+#   python depth_report.py [-j PROCESSES] [--screen-width MM] REPORT FILE_OR_DIRECTORY...
+#
+# writes the nearest and furthest disparity on screen of each .spct file (or
+# the most recent .spct file of each image in the directories) to REPORT, as
+# CSV or JSON depending on its extension. Disparities are percentages of the
+# width of the exported image, which is what fills the screen.
+
+from __future__ import print_function
+
+import sys, os, time, csv, json
+import argparse, itertools, multiprocessing
+
+import stereo_image
+import navigation
+import disparity
+import stereo_window
+
+# Width the eyes are decoded and reduced to. JPEG based images with eyes 5120
+# or more pixels wide are decoded at 1/8 scale for this, which along with the
+# matching takes less time on each core than reading the file does:
+analysis_width = 640
+
+# Disparities between the nearest and furthest parts of an image larger than
+# this percentage of the width are reported as over the depth budget:
+default_budget = 3.0
+
+# Images with things further apart than the eyes on the target screen force
+# the eyes to diverge to look at them:
+default_eye_separation = 65.0
+
+# Images where less than this fraction of the crop could be matched are
+# reported as unable to match rather than with unreliable disparities, e.g.
+# if the vertical alignment is wrong or the eyes are not a stereo pair:
+min_matched = 0.25
+
+columns = ('spct', 'source', 'near', 'far', 'depth', 'near_mm', 'far_mm', 'matched', 'problems')
+
+def output_width_fraction(adj):
+    '''
+    Returns the width of the image exported with these adjustments as a
+    fraction of the width of each eye.
+    '''
+    h_offset = stereo_image.trim_horizontal_offsets_left(adj.calc_horizontal_offsets())
+    return max(adj.hcrop[0][1] - adj.hcrop[0][0] + h_offset[0],
+            adj.hcrop[1][1] - adj.hcrop[1][0] + h_offset[1])
+
+def adjusted_disparity(eyes, adj, width=analysis_width):
+    '''
+    Returns the DisparityMap of the part of the left eye inside the crop, with
+    the vertical alignment applied. The parallax is not applied.
+    '''
+    left, right = stereo_window.reduce_eyes(eyes, width)
+    h, w = left.shape
+    (x0, y0, x1, y1), dy = stereo_window.left_eye_crop(adj, (w, h))
+    # The crop and the vertical alignment are rounded separately, which can
+    # put the same rows of the right eye one past its top or bottom:
+    y0, y1 = max(y0, 0, -dy), min(y1, h, h - dy)
+    if x1 - x0 < 1 or y1 - y0 < 1:
+        raise ValueError('The crop is empty')
+    # The whole width is matched, since things inside the crop of the left
+    # eye may be outside it in the right eye:
+    found, valid = disparity.block_match(left[y0:y1], right[y0 + dy : y1 + dy])
+    return disparity.DisparityMap(found[:, x0:x1] * 100.0 / w, valid[:, x0:x1])
+
+def measure(spct_filename, budget=default_budget, screen_width=None,
+        eye_separation=default_eye_separation):
+    '''
+    Returns the row of the report for one .spct file as a dict.
+    '''
+    source, adj = stereo_image.load_spct(spct_filename)
+    disparities = adjusted_disparity(disparity.load_eyes(source, analysis_width), adj)
+    row = dict.fromkeys(columns)
+    row.update(spct=spct_filename, source=source, matched=round(float(disparities.valid.mean()), 3))
+
+    disparity_range = disparities.range(adj.parallax)
+    if disparity_range is None or row['matched'] < min_matched:
+        row['problems'] = 'unable to match'
+        return row
+
+    # The exported image is scaled to fill the screen:
+    scale = 1.0 / output_width_fraction(adj)
+    near, far = [ d * scale for d in disparity_range ]
+    row.update(near=round(near, 3), far=round(far, 3), depth=round(far - near, 3))
+    problems = []
+    if far - near > budget:
+        problems.append('over budget')
+    if screen_width is not None:
+        row.update(near_mm=round(near * screen_width / 100.0, 1), far_mm=round(far * screen_width / 100.0, 1))
+        if row['far_mm'] > eye_separation:
+            problems.append('diverges')
+    row['problems'] = ', '.join(problems)
+    return row
+
+def measure_worker(args):
+    # Runs in the worker processes, so must not raise:
+    filename = args[0]
+    try:
+        return filename, measure(*args), None
+    except (IOError, OSError, ValueError, stereo_image.SpctError, stereo_image.UnsupportedImageError) as e:
+        return filename, None, str(e)
+    except Exception as e:
+        # Anything else is a bug, but should only lose this file from the
+        # report rather than the whole run:
+        return filename, None, '%s: %s' % (e.__class__.__name__, str(e))
+
+def write_report(filename, rows):
+    if os.path.splitext(filename)[1].lower() == '.json':
+        with open(filename, 'w') as f:
+            json.dump(rows, f, indent=2, sort_keys=True, separators=(',', ': '))
+        return
+    with open(filename, 'wb') as f:
+        writer = csv.DictWriter(f, columns)
+        writer.writeheader()
+        writer.writerows(rows)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description = 'Report the nearest and '
+            'furthest disparity on screen of .spct files')
+    parser.add_argument('report',
+            help='File to write the report to, as JSON if it ends in .json or CSV otherwise')
+    parser.add_argument('files', nargs='+', metavar='path',
+            help='.spct files, or directories to search for the most recent '
+            '.spct file of each image')
+    parser.add_argument('-j', '--jobs', type=int, default=multiprocessing.cpu_count(),
+            help='Number of images to measure in parallel (default: %(default)s)')
+    parser.add_argument('--budget', type=float, default=default_budget,
+            help='Largest comfortable difference between the nearest and furthest '
+            'disparity, in percent of the width (default: %(default)s)')
+    parser.add_argument('--screen-width', type=float,
+            help='Width of the target screen in mm, to report disparities in mm '
+            'and find images that would make the eyes diverge')
+    parser.add_argument('--eye-separation', type=float, default=default_eye_separation,
+            help='Distance between the eyes in mm (default: %(default)s)')
+    return parser.parse_args()
+
+def main():
+    multiprocessing.freeze_support()
+    args = parse_args()
+
+    files = list(itertools.chain(*[ navigation.find_spct_files(path)
+            if os.path.isdir(path) else [path] for path in args.files ]))
+    tasks = [ (filename, args.budget, args.screen_width, args.eye_separation) for filename in files ]
+    if args.jobs > 1 and len(files) > 1:
+        pool = multiprocessing.Pool(args.jobs)
+        results = pool.imap(measure_worker, tasks)
+    else:
+        pool = None
+        results = itertools.imap(measure_worker, tasks)
+
+    rows = []
+    failed = 0
+    start = time.time()
+    for i, (filename, row, error) in enumerate(results, 1):
+        if error is not None:
+            print('[%i/%i] Unable to measure %s: %s' % (i, len(files), filename, error), file=sys.stderr)
+            failed += 1
+            continue
+        rows.append(row)
+        if row['near'] is None:
+            print('[%i/%i] %s: %s' % (i, len(files), filename, row['problems']))
+        else:
+            print('[%i/%i] %s: %.2f%% to %.2f%%%s' % (i, len(files), filename, row['near'], row['far'],
+                ' (%s)' % row['problems'] if row['problems'] else ''))
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    write_report(args.report, rows)
+    problems = len([ row for row in rows if row['problems'] ])
+    print('%i measured, %i with problems, %i failed in %.1f seconds' %
+            (len(rows), problems, failed, time.time() - start))
+    if failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
+
+# vi:et:sw=4:ts=4
@@ -392,6 +392,7 @@ class Frame(object):
 
         self.OnCreateDevice()
         self.OnResetDevice()
+        self.OnInvalidate()
 
     def Mainloop(self):
         """Starts the mainloop. The loop will call
@@ -401,23 +402,27 @@ class Frame(object):
         self.time = time.clock()
 
         while 1:
-            #We run this loop as fast as possible.
-            #Add some throttling if needed.
+            #Unless NeedsRender() is overridden this runs
+            #as fast as possible, otherwise it sleeps until
+            #a message, timer or WakeUp() arrives.
             if not self._pauses:
                 self.OnUpdate()
 
-            self.device.Clear(0, None, D3DCLEAR.TARGET | D3DCLEAR.ZBUFFER,
-                0xff0000ff, 1.0, 0)
-            self.device.BeginScene()
-            self.device.SetRenderState(D3DRS.FILLMODE, self._fillmode)
+            if self.NeedsRender():
+                self.device.Clear(0, None, D3DCLEAR.TARGET | D3DCLEAR.ZBUFFER,
+                    0xff0000ff, 1.0, 0)
+                self.device.BeginScene()
+                self.device.SetRenderState(D3DRS.FILLMODE, self._fillmode)
 
-            self.OnRender()
+                self.OnRender()
 
-            self.device.EndScene()
-            try:
-                self.device.Present(None, None, 0, None)
-            except:
-                self.ResetDevice()
+                self.device.EndScene()
+                try:
+                    self.device.Present(None, None, 0, None)
+                except:
+                    self.ResetDevice()
+            else:
+                self.WaitForMessages()
 
             if self._pauses:
                 #Paused, time does not advance.
@@ -471,6 +476,23 @@ class Frame(object):
         #Exit (maybe) via exception.
         sys.exit(int(status))
 
+    def WaitForMessages(self):
+        """Sleeps until a message arrives or the next timer
+           is due. Returns immediately if there are already
+           messages waiting."""
+        timeout = 0xFFFFFFFF #INFINITE
+        if self._timers and not self._pauses:
+            due = min([timer[0] + timer[1] for timer in self._timers])
+            timeout = max(0, int((due - (time.clock() - self._pausetime)) * 1000.0))
+        windll.user32.MsgWaitForMultipleObjectsEx(DWORD(0), None,
+            DWORD(timeout), DWORD(0x04FF), DWORD(0x0004)) #QS_ALLINPUT, MWMO_INPUTAVAILABLE
+
+    def WakeUp(self):
+        """Wakes the Mainloop() from WaitForMessages() so that
+           OnUpdate() is called. Safe to call from other threads."""
+        if self.hwnd:
+            windll.user32.PostMessageA(self.hwnd, UINT(0), WPARAM(0), LPARAM(0)) #WM_NULL
+
     def ProcessMessages(self):
         """Process all waiting messages."""
         msg = MSG()
@@ -552,6 +574,7 @@ class Frame(object):
 
         self.font.OnResetDevice()
         self.OnResetDevice()
+        self.OnInvalidate()
 
         self.Pause(False)
         self.OnUpdate()
@@ -633,6 +656,19 @@ class Frame(object):
            scene needs to be updated."""
         pass
 
+    def NeedsRender(self):
+        """Called once per frame after OnUpdate(). Return False
+           if nothing has changed since the last frame was
+           rendered, and the Mainloop() will wait for the next
+           message instead of rendering it again."""
+        return True
+
+    def OnInvalidate(self):
+        """Called when the contents of the window have been lost,
+           e.g. it was uncovered or the device was reset, and
+           the next frame must be rendered."""
+        pass
+
     def OnRender(self):
         """Called once per frame, even if paused."""
         pass
@@ -698,6 +734,9 @@ def _WndProc(hwnd, msg, wParam, lParam):
         elif msg in _keyevents:
             self.OnKey(args)
             return 0
+        elif msg == 0x000F:
+            #WM_PAINT - still passed on to DefWindowProc to validate it.
+            self.OnInvalidate()
         elif msg == 0x0084:
             #WM_NCHITTEST
             if self.fullscreen:
@@ -0,0 +1,329 @@
+#!/usr/bin/env python
+
+# Copyright 2016 Ian Munsie
+#
+# This file is part of the Stereo Cropping Tool.
+#
+# The Stereo Cropping Tool is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The Stereo Cropping Tool is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# The Stereo Cropping Tool. If not, see <http://www.gnu.org/licenses/>.
+
+# Estimates the disparity (the horizontal shift between the eyes) of every
+# part of a stereo image by block matching, coarse to fine: every shift is
+# only tried on a small copy of the image, and each larger copy only refines
+# the shifts found at the previous size. Disparities are reported as a
+# percentage of the width, in the same units as Adjustments.parallax, so that
+# the disparity of something on screen is its disparity here plus the
+# parallax. Positive disparities are behind the screen and negative
+# disparities in front of it.
+#
+#   python disparity.py [-j THREADS] [-n] FILE_OR_DIRECTORY...
+#
+# prints the disparity range of each .spct file (or the most recent .spct
+# file of each image in the directories) and saves its disparity map
+# alongside it as a 16 bit PNG.
+
+from __future__ import print_function
+
+import sys, os, time, math
+import argparse
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+from PIL import Image, PngImagePlugin
+
+import stereo_image
+import navigation
+import auto_align
+
+# Width the eyes are reduced to, which is also the width of the disparity
+# map. One pixel is 0.065% of the width, and the matches are located to a
+# fraction of that:
+default_map_width = 1536
+
+# Every shift up to this fraction of the width either way is tried at the
+# smallest size, which is the most the disparity can be anywhere:
+max_disparity = 0.2
+
+# Pyramid levels are halved until the largest shift is no more than this many
+# pixels, where every shift is tried:
+coarsest_shift = 24
+
+# Blocks of (2 * radius + 1) square pixels are matched:
+block_radius = 4
+
+# Shifts either side of the previous level's estimate tried at each level:
+refine_search = 2
+
+# Rows per band processed on the thread pool:
+band_rows = 96
+
+# Blocks with less horizontal detail than this (mean absolute horizontal
+# gradient, in grey levels) can't be matched reliably:
+min_texture = 2.0
+
+# Pixels whose match in the other eye doesn't match back to within this many
+# pixels are unreliable, which is usually because they are hidden from the
+# other eye behind something nearer or by the edge of the image:
+max_inconsistency = 1.0
+
+# Disparities are stored in the PNG as 1/256ths of a percent of the width,
+# offset by 32768, with 0 for pixels without a disparity:
+png_scale = 256.0
+png_offset = 32768
+
+default_threads = 4
+
+def box_filter(a, radius):
+    '''
+    Returns the sum of each (2 * radius + 1) square block of the last two
+    axes of a, with the edges extended. The rows and columns are summed
+    separately so that the running sums stay small enough for float32.
+    '''
+    k = 2 * radius + 1
+    for axis in (-1, -2):
+        pad = [(0, 0)] * a.ndim
+        pad[axis] = (radius + 1, radius)
+        c = np.pad(a, pad, 'edge').cumsum(axis=axis, dtype=np.float32)
+        if axis == -1:
+            a = c[..., k:] - c[..., :-k]
+        else:
+            a = c[..., k:, :] - c[..., :-k, :]
+    return a
+
+def downsample(a):
+    h, w = a.shape[0] // 2 * 2, a.shape[1] // 2 * 2
+    a = a[:h, :w]
+    return (a[0::2, 0::2] + a[1::2, 0::2] + a[0::2, 1::2] + a[1::2, 1::2]) * 0.25
+
+def upsample_disparity(disparity, shape):
+    # Disparities double along with the width:
+    up = np.repeat(np.repeat(disparity, 2, axis=0), 2, axis=1) * 2
+    up = np.pad(up, ((0, max(0, shape[0] - up.shape[0])), (0, max(0, shape[1] - up.shape[1]))), 'edge')
+    return up[:shape[0], :shape[1]]
+
+def match_costs(left, right, disparity, offsets, radius):
+    '''
+    Returns the block matching cost of each pixel of left against right at
+    each of offsets from its own disparity, as an array of
+    (len(offsets), rows, columns).
+    '''
+    h, w = left.shape
+    rows = np.arange(h)[:, np.newaxis]
+    columns = np.arange(w)[np.newaxis, :] + disparity
+    differences = np.empty((len(offsets), h, w), np.float32)
+    for i, offset in enumerate(offsets):
+        np.abs(left - right[rows, np.clip(columns + offset, 0, w - 1)], out=differences[i])
+    return box_filter(differences, radius)
+
+def in_bands(function, shape, radius, pool, *arrays):
+    '''
+    Calls function(*bands) on bands of rows of each of arrays on the thread
+    pool (or in this thread if pool is None), where each band overlaps its
+    neighbours by radius rows so that the block sums are the same as for the
+    whole image, and returns the results joined back together along the rows.
+    '''
+    def band(y):
+        y0, y1 = max(0, y - radius), min(shape[0], y + band_rows + radius)
+        result = function(*[ a[y0:y1] for a in arrays ])
+        return result[..., y - y0 : y - y0 + min(band_rows, shape[0] - y), :]
+    results = (pool.map if pool is not None else map)(band, range(0, shape[0], band_rows))
+    return np.concatenate(results, axis=-2)
+
+def match_one_way(left, right, pool, max_shift, radius):
+    pyramid = [ (left, right) ]
+    while max_shift / 2 ** (len(pyramid) - 1) > coarsest_shift and min(pyramid[-1][0].shape) > 4 * radius:
+        pyramid.append(tuple(downsample(a) for a in pyramid[-1]))
+
+    # Try every shift at the smallest size:
+    l, r = pyramid[-1]
+    max_d = max(1, int(math.ceil(max_shift * l.shape[1] / left.shape[1])))
+    offsets = np.arange(-max_d, max_d + 1)
+    zero = np.zeros(l.shape, np.int32)
+    costs = in_bands(lambda l, r, d: match_costs(l, r, d, offsets, radius), l.shape, radius, pool, l, r, zero)
+    best = costs.argmin(axis=0)
+    disparity = offsets[best].astype(np.int32)
+
+    # Then refine the shifts at each larger size:
+    offsets = np.arange(-refine_search, refine_search + 1)
+    for l, r in reversed(pyramid[:-1]):
+        disparity = upsample_disparity(disparity, l.shape)
+        costs = in_bands(lambda l, r, d: match_costs(l, r, d, offsets, radius), l.shape, radius, pool, l, r, disparity)
+        best = costs.argmin(axis=0)
+        disparity = disparity + offsets[best]
+
+    # Fit a parabola through the costs either side of the best match:
+    interior = (best > 0) & (best < len(offsets) - 1)
+    i = np.clip(best, 1, len(offsets) - 2)
+    rows, columns = np.indices(best.shape)
+    c_l, c, c_r = costs[i - 1, rows, columns], costs[i, rows, columns], costs[i + 1, rows, columns]
+    denominator = c_l - 2.0 * c + c_r
+    fraction = np.where(interior & (denominator > 0), 0.5 * (c_l - c_r) / np.maximum(denominator, 1e-9), 0.0)
+
+    # Blocks without enough detail to match, or that matched against the
+    # edge of the other eye, are unreliable:
+    texture = box_filter(np.abs(np.diff(left, axis=1, prepend=left[:, :1])), radius) / (2 * radius + 1) ** 2
+    x = np.arange(left.shape[1])[np.newaxis, :] + disparity
+    valid = interior & (texture >= min_texture) & (x >= radius) & (x < left.shape[1] - radius)
+    return disparity + fraction, valid
+
+def block_match(left, right, pool=None, max_shift=None, radius=block_radius):
+    '''
+    Returns the disparity of each pixel of left in right in pixels, i.e. the
+    x + disparity where each pixel is found in right, and whether it is
+    reliable. Disparities up to max_shift pixels either way are found, which
+    defaults to max_disparity of the width. The right eye is matched against
+    the left as well, and pixels that don't match back to where they started
+    are unreliable.
+    '''
+    if max_shift is None:
+        max_shift = left.shape[1] * max_disparity
+    disparity, valid = match_one_way(left, right, pool, max_shift, radius)
+    back, back_valid = match_one_way(right, left, pool, max_shift, radius)
+
+    rows = np.arange(left.shape[0])[:, np.newaxis]
+    x = np.clip(np.round(np.arange(left.shape[1])[np.newaxis, :] + disparity).astype(np.int32),
+            0, left.shape[1] - 1)
+    valid &= back_valid[rows, x] & (np.abs(disparity + back[rows, x]) <= max_inconsistency)
+    return disparity, valid
+
+class DisparityMap(object):
+    '''
+    The disparity of each pixel of the left eye as a percentage of the width,
+    as returned by compute(), and a mask of the pixels where it is reliable.
+    '''
+    def __init__(self, disparity, valid):
+        self.disparity = disparity
+        self.valid = valid
+
+    @property
+    def size(self):
+        return (self.disparity.shape[1], self.disparity.shape[0])
+
+    def values(self, parallax=0.0):
+        '''
+        Returns the reliable disparities, as they would be on screen after
+        applying the parallax.
+        '''
+        return self.disparity[self.valid] + parallax
+
+    def percentile(self, q, parallax=0.0):
+        values = self.values(parallax)
+        if not len(values):
+            return None
+        return float(np.percentile(values, q))
+
+    def range(self, parallax=0.0, low=1.0, high=99.0):
+        '''
+        Returns the nearest and furthest disparity, leaving out the given
+        percentiles of outliers at either end, or None if there are no
+        reliable disparities.
+        '''
+        values = self.values(parallax)
+        if not len(values):
+            return None
+        near, far = np.percentile(values, (low, high))
+        return float(near), float(far)
+
+    def save(self, filename):
+        encoded = np.where(self.valid, np.clip(np.round(self.disparity * png_scale) + png_offset, 1, 65535), 0)
+        info = PngImagePlugin.PngInfo()
+        info.add_text('Description', 'Disparity as (percent of width * %g + %i), 0 = unknown' % (png_scale, png_offset))
+        Image.fromarray(encoded.astype(np.uint16)).save(filename, format='PNG', pnginfo=info)
+
+    @classmethod
+    def load(cls, filename):
+        encoded = np.asarray(Image.open(filename), np.int32)
+        return cls((encoded - png_offset) / png_scale, encoded != 0)
+
+def compute(eyes, vertical_alignment=0.0, map_width=default_map_width, threads=default_threads):
+    '''
+    Computes the DisparityMap of the left and right eyes of a stereo image,
+    at any resolution, lined up with the given vertical alignment first.
+    '''
+    left = auto_align.reduce_eye(eyes[0], map_width)
+    right = auto_align.reduce_eye(eyes[1], map_width)
+
+    # A row y of the left eye is row y + dy of the right eye:
+    dy = int(round(vertical_alignment * left.shape[0]))
+    if dy > 0:
+        left, right = left[:-dy], right[dy:]
+    elif dy < 0:
+        left, right = left[-dy:], right[:dy]
+
+    if threads <= 1:
+        disparity, valid = block_match(left, right)
+    else:
+        pool = ThreadPool(threads)
+        try:
+            disparity, valid = block_match(left, right, pool)
+        finally:
+            pool.close()
+            pool.join()
+    return DisparityMap(disparity * 100.0 / left.shape[1], valid)
+
+def map_filename(spct_filename):
+    return os.path.splitext(spct_filename)[0] + '.disparity.png'
+
+def load_eyes(filename, map_width=default_map_width):
+    # JPEG based images only need to be decoded to the width of the map:
+    eye_size = stereo_image.get_eye_size(filename)
+    return stereo_image.decode_stereo_image(filename, (map_width, eye_size[1] * map_width // eye_size[0]))
+
+def parse_args():
+    parser = argparse.ArgumentParser(description = 'Estimate the range of '
+            'disparities of .spct files and save their disparity maps')
+    parser.add_argument('files', nargs='+', metavar='path',
+            help='.spct files, or directories to search for the most recent '
+            '.spct file of each image')
+    parser.add_argument('-j', '--threads', type=int, default=default_threads,
+            help='Number of threads to match each image with (default: %(default)s)')
+    parser.add_argument('-n', '--no-save', action='store_true',
+            help='Only print the disparity ranges, without saving the maps')
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    files = []
+    for path in args.files:
+        if os.path.isdir(path):
+            files.extend(navigation.find_spct_files(path))
+        else:
+            files.append(path)
+
+    failed = 0
+    start = time.time()
+    for i, filename in enumerate(files, 1):
+        try:
+            source, adj = stereo_image.load_spct(filename)
+            disparities = compute(load_eyes(source), adj.vertical_alignment, threads=args.threads)
+        except (IOError, OSError, ValueError, stereo_image.SpctError, stereo_image.UnsupportedImageError) as e:
+            print('[%i/%i] Unable to estimate the disparity of %s: %s' % (i, len(files), filename, str(e)), file=sys.stderr)
+            failed += 1
+            continue
+        if not args.no_save:
+            disparities.save(map_filename(filename))
+        disparity_range = disparities.range(adj.parallax)
+        if disparity_range is None:
+            print('[%i/%i] %s: No reliable disparities' % (i, len(files), filename))
+        else:
+            print('[%i/%i] %s: Disparity %.2f%% to %.2f%% of the width, median %.2f%%' % ((i, len(files), filename) +
+                disparity_range + (disparities.percentile(50, adj.parallax),)))
+
+    print('%i estimated, %i failed in %.1f seconds' % (len(files) - failed, failed, time.time() - start))
+    if failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
+
+# vi:et:sw=4:ts=4
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+
+# Copyright 2016 Ian Munsie
+#
+# This file is part of the Stereo Cropping Tool.
+#
+# The Stereo Cropping Tool is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The Stereo Cropping Tool is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# The Stereo Cropping Tool. If not, see <http://www.gnu.org/licenses/>.
+
+# Encoder settings used when exporting adjusted images. Each .spct file names
+# the profile its image was exported with, and the presets below can be
+# modified or added to in the config file, e.g.:
+#
+#   {
+#     "export_profiles": {
+#       "master": {"quality": 92},
+#       "web": {"quality": 85, "subsampling": "4:2:0", "progressive": true}
+#     }
+#   }
+
+from __future__ import print_function
+
+import os, json
+from collections import OrderedDict
+
+config_filename = os.path.join(os.path.expanduser('~'), '.stereo_cropper.json')
+
+subsampling_modes = {
+    '4:4:4': 0,
+    '4:2:2': 1,
+    '4:2:0': 2,
+}
+
+class ExportProfile(object):
+    '''
+    quality and subsampling only apply when an image is re-encoded, the rest
+    also apply to lossless exports. keep_metadata copies the EXIF data and
+    ICC profile of the source image into the exported image (only the ICC
+    profile for PNG). png_compress_level is the zlib level for .pns output.
+    '''
+    settings = ('quality', 'subsampling', 'optimize', 'progressive',
+            'keep_metadata', 'png_compress_level')
+
+    def __init__(self, name, quality=75, subsampling='4:2:0', optimize=False,
+            progressive=False, keep_metadata=False, png_compress_level=6):
+        if subsampling not in subsampling_modes:
+            raise ValueError('Invalid chroma subsampling %r in export profile %s' % (subsampling, name))
+        self.name = name
+        self.quality = quality
+        self.subsampling = subsampling
+        self.optimize = optimize
+        self.progressive = progressive
+        self.keep_metadata = keep_metadata
+        self.png_compress_level = png_compress_level
+
+    def updated(self, name, settings):
+        '''
+        Returns a new profile with some settings replaced from a dictionary.
+        '''
+        unknown = set(settings) - set(self.settings)
+        if unknown:
+            raise ValueError('Unknown settings in export profile %s: %s' % (name, ', '.join(sorted(unknown))))
+        kwargs = dict((k, getattr(self, k)) for k in self.settings)
+        kwargs.update(settings)
+        return ExportProfile(name, **kwargs)
+
+    def jpeg_options(self, source_info):
+        '''
+        Returns the keyword arguments to pass to Pillow to save a JPEG with
+        this profile. source_info is the info dictionary of the source image.
+        '''
+        options = {
+            'quality': self.quality,
+            'subsampling': subsampling_modes[self.subsampling],
+            'optimize': self.optimize,
+            'progressive': self.progressive,
+        }
+        if self.keep_metadata:
+            for key in ('exif', 'icc_profile'):
+                if source_info.get(key):
+                    options[key] = source_info[key]
+        return options
+
+    def jpegtran_options(self):
+        # Metadata is not included here, since jpegtran can only copy it from
+        # the image it is transforming, which is not always the source image:
+        options = []
+        if self.optimize:
+            options.append('-optimize')
+        if self.progressive:
+            options.append('-progressive')
+        return options
+
+presets = OrderedDict((
+    # Pillow's JPEG defaults, which is what every image was exported with
+    # before profiles existed. Quick to encode for reviewing a batch of images:
+    ('proof', ExportProfile('proof', png_compress_level=1)),
+
+    # For the final export - high quality without chroma subsampling, with
+    # the extra encoding passes to make the files smaller:
+    ('master', ExportProfile('master', quality=95, subsampling='4:4:4',
+        optimize=True, progressive=True, keep_metadata=True, png_compress_level=9)),
+))
+
+default_profile = 'proof'
+
+_profiles = None
+_warned_missing = set()
+
+def load_profiles(filename=config_filename):
+    '''
+    Returns the presets updated with any profiles in the config file.
+    '''
+    profiles = OrderedDict(presets)
+    if not os.path.exists(filename):
+        return profiles
+    with open(filename, 'r') as f:
+        config = json.load(f, object_pairs_hook=OrderedDict)
+    for name, settings in config.get('export_profiles', {}).items():
+        base = profiles.get(name, presets[default_profile])
+        profiles[name] = base.updated(name, settings)
+    return profiles
+
+def profiles():
+    global _profiles
+    if _profiles is None:
+        try:
+            _profiles = load_profiles()
+        except (IOError, ValueError) as e:
+            print('Unable to load export profiles from %s: %s' % (config_filename, str(e)))
+            _profiles = OrderedDict(presets)
+    return _profiles
+
+def profile_names():
+    return list(profiles().keys())
+
+def get_profile(name=None):
+    '''
+    Returns the named export profile, or the default profile if name is None.
+    Raises KeyError if there is no such profile.
+    '''
+    if name is None:
+        name = default_profile
+    try:
+        return profiles()[name]
+    except KeyError:
+        raise KeyError('No export profile named %s' % name)
+
+def available_profile(name):
+    '''
+    Returns name if it is an export profile that exists here, or None (the
+    default profile) if not, e.g. for a .spct file saved on another computer
+    with its own profiles. Warns the first time each missing profile is seen.
+    '''
+    if name is None or name in profiles():
+        return name
+    if name not in _warned_missing:
+        _warned_missing.add(name)
+        print('No export profile named %s, using %s instead' % (name, default_profile))
+    return None
+
+# vi:et:sw=4:ts=4
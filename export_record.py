@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+
+# Copyright 2016 Ian Munsie
+#
+# This file is part of the Stereo Cropping Tool.
+#
+# The Stereo Cropping Tool is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The Stereo Cropping Tool is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# The Stereo Cropping Tool. If not, see <http://www.gnu.org/licenses/>.
+
+# A record of what the image saved alongside a .spct file was exported from,
+# stored in the .spct file, so that re-exporting can skip images whose source
+# and adjustments have not changed since. The source is identified by a hash
+# of its contents rather than its modification time, so that copying an
+# archive to a new drive or touching the files does not cause everything to
+# be exported again. The hash is only recalculated when the size or
+# modification time of the source no longer match the record.
+
+import os, json, hashlib
+
+import lossless_crop
+
+def file_hash(filename):
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        while True:
+            data = f.read(1024 * 1024)
+            if not data:
+                break
+            h.update(data)
+    return h.hexdigest()
+
+def params_hash(adj, profile, lossless, output_filename):
+    '''
+    Returns a hash of everything other than the source image that affects the
+    exported image, where lossless is whether it was saved without
+    re-encoding. Values are rounded so that floating point noise from
+    converting them back and forth does not register as a change.
+    '''
+    params = {
+        'parallax': round(adj.parallax, 9),
+        'vertical_alignment': round(adj.vertical_alignment, 9),
+        'vcrop': [ round(v, 9) for v in adj.vcrop ],
+        'hcrop': [ [ round(v, 9) for v in h ] for h in adj.hcrop ],
+        'background': adj.background,
+        'profile': [ profile.name ] + [ getattr(profile, k) for k in profile.settings ],
+        'lossless': bool(lossless),
+        'format': os.path.splitext(output_filename)[1].lower(),
+    }
+    return hashlib.sha1(json.dumps(params, sort_keys=True)).hexdigest()
+
+def source_hash(source, previous=None):
+    # Reuses the hash in a previous record if the source looks unmodified:
+    st = os.stat(source)
+    if previous is not None and previous['source_size'] == st.st_size \
+            and previous['source_mtime'] == st.st_mtime:
+        return previous['source_sha1'], st
+    return file_hash(source), st
+
+def make_record(source, adj, profile, lossless, output_filename, previous=None):
+    '''
+    Returns the record to store in the .spct file after exporting source to
+    output_filename with the given adjustments and export profile, losslessly
+    or not.
+    '''
+    sha1, st = source_hash(source, previous)
+    return {
+        'source_sha1': sha1,
+        'source_size': st.st_size,
+        'source_mtime': st.st_mtime,
+        'params': params_hash(adj, profile, lossless, output_filename),
+        'output_size': os.stat(output_filename).st_size,
+    }
+
+def is_current(record, source, adj, profile, lossless, output_filename):
+    '''
+    Returns True if exporting source with these adjustments would reproduce
+    the output described by a record from a previous export, which is still
+    in place. lossless is whether a lossless export is requested, which the
+    record is only current for if it was saved the same way it would be now.
+    '''
+    if record is None:
+        return False
+    try:
+        if os.stat(output_filename).st_size != record['output_size']:
+            return False
+        if params_hash(adj, profile, True, output_filename) == record['params']:
+            # Saved losslessly, which will happen again for the same source
+            # and adjustments if jpegtran is still available:
+            if not lossless or lossless_crop.find_jpegtran() is None:
+                return False
+        elif params_hash(adj, profile, False, output_filename) == record['params']:
+            # Re-encoded, which is out of date if it can now be saved
+            # losslessly, e.g. since jpegtran was installed:
+            if lossless and lossless_crop.can_save_lossless(source, adj):
+                return False
+        else:
+            return False
+        return source_hash(source, record)[0] == record['source_sha1']
+    except (IOError, OSError):
+        return False
+
+def refreshed(record, source):
+    '''
+    Returns a copy of a current record updated with the size and modification
+    time of the source, or None if they haven't changed, so that a source
+    that was touched but not modified is not hashed again on every export.
+    '''
+    st = os.stat(source)
+    if record['source_size'] == st.st_size and record['source_mtime'] == st.st_mtime:
+        return None
+    record = dict(record)
+    record['source_size'] = st.st_size
+    record['source_mtime'] = st.st_mtime
+    return record
+
+# vi:et:sw=4:ts=4
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+# Copyright 2016 Ian Munsie
+#
+# This file is part of the Stereo Cropping Tool.
+#
+# The Stereo Cropping Tool is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The Stereo Cropping Tool is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# The Stereo Cropping Tool. If not, see <http://www.gnu.org/licenses/>.
+
+import os, threading
+from collections import OrderedDict
+
+def file_signature(filename):
+    # Used to detect if a file was modified after it was cached:
+    st = os.stat(filename)
+    return (st.st_mtime, st.st_size)
+
+def image_nbytes(image):
+    # Pillow stores everything other than 1, L and P mode images with 32 bits
+    # per pixel, including 24bpp RGB images:
+    if image.mode in ('1', 'L', 'P'):
+        return image.width * image.height
+    return image.width * image.height * 4
+
+class EyeCache(object):
+    '''
+    A least recently used cache of decoded stereo images, bounded by the
+    approximate number of bytes of decoded pixels held. Entries remember the
+    modification time and size of the file they were decoded from, so a file
+    that has been modified since (e.g. re-exported from rawtherapee) will be
+    decoded again rather than served stale. Safe to use from multiple threads.
+    '''
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict() # Path -> (signature, eyes, nbytes)
+        self.nbytes = 0
+        self.hits = self.misses = self.evictions = 0
+
+    def _remove(self, key):
+        self.nbytes -= self.entries.pop(key)[2]
+
+    def get(self, filename):
+        key = os.path.abspath(filename)
+        try:
+            signature = file_signature(filename)
+        except OSError:
+            signature = None
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] != signature:
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None
+            # Move to the most recently used end:
+            del self.entries[key]
+            self.entries[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def __contains__(self, filename):
+        # Does not check if the file has been modified, get() will do that
+        with self.lock:
+            return os.path.abspath(filename) in self.entries
+
+    def put(self, filename, eyes, signature):
+        key = os.path.abspath(filename)
+        # Both eyes of a mono image are the same image:
+        nbytes = sum(image_nbytes(image) for image in set(eyes))
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            if nbytes > self.max_bytes:
+                return
+            while self.nbytes + nbytes > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+            self.entries[key] = (signature, eyes, nbytes)
+            self.nbytes += nbytes
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+    def __str__(self):
+        return 'Image cache: %i hits, %i misses, %i evictions, %.1f of %.1f MB used' % \
+                (self.hits, self.misses, self.evictions,
+                 self.nbytes / 1048576.0, self.max_bytes / 1048576.0)
+
+# vi:et:sw=4:ts=4
@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+
+# Copyright 2016 Ian Munsie
+#
+# This file is part of the Stereo Cropping Tool.
+#
+# The Stereo Cropping Tool is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The Stereo Cropping Tool is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# The Stereo Cropping Tool. If not, see <http://www.gnu.org/licenses/>.
+
+# Lossless export of JPEG based stereo images. When the crop of each eye
+# starts on an MCU boundary (or can be moved to one by a few pixels) and
+# fills its half of the output, the side by side image can be assembled from
+# the original compressed blocks with jpegtran instead of being decoded and
+# re-encoded. This needs a jpegtran that supports -crop expanding the image
+# and -drop, i.e. libjpeg 9 or libjpeg-turbo 2.1 or later. If that is not
+# available, or the adjustments can't be done losslessly, the caller falls
+# back to re-encoding the image.
+
+from __future__ import print_function
+
+import os, io, struct, subprocess, tempfile, shutil
+from distutils.spawn import find_executable
+
+from PIL import Image
+
+import stereo_image
+
+# Crops that are within this many pixels of an MCU boundary are moved to it:
+default_snap_tolerance = 2
+
+_jpegtran = None
+
+def find_jpegtran():
+    '''
+    Returns the path to a jpegtran that supports -drop, or None.
+    '''
+    global _jpegtran
+    if _jpegtran is None:
+        _jpegtran = ''
+        path = find_executable('jpegtran')
+        if path is not None:
+            try:
+                p = subprocess.Popen([path, '-help'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                out, err = p.communicate()
+            except OSError:
+                pass
+            else:
+                if '-drop' in out + err:
+                    _jpegtran = path
+    return _jpegtran or None
+
+def jpeg_segments(data):
+    '''
+    Yields the marker, offset and payload of each segment in the header of a
+    JPEG, up to the start of the compressed data.
+    '''
+    pos = 2 # After SOI
+    while pos + 4 <= len(data) and data[pos] == b'\xff':
+        marker = ord(data[pos + 1])
+        if marker == 0xda: # SOS
+            return
+        length = struct.unpack('>H', data[pos + 2 : pos + 4])[0]
+        yield marker, pos + 4, data[pos + 4 : pos + 2 + length]
+        pos += 2 + length
+
+def mcu_size(data):
+    '''
+    Returns the width and height of the MCUs of a JPEG, which depends on the
+    chroma subsampling, or None if it has no frame header.
+    '''
+    for marker, start, payload in jpeg_segments(data):
+        if 0xc0 <= marker <= 0xcf and marker not in (0xc4, 0xc8, 0xcc):
+            components = ord(payload[5])
+            factors = [ ord(payload[7 + 3 * i]) for i in range(components) ]
+            return 8 * max(f >> 4 for f in factors), 8 * max(f & 0xf for f in factors)
+    return None
+
+def mpo_frames(data):
+    '''
+    Returns the (offset, size) of each image in an MPO file from the MP index
+    in the APP2 segment of the first image, or None if there isn't one.
+    '''
+    for marker, start, payload in jpeg_segments(data):
+        if marker == 0xe2 and payload.startswith(b'MPF\0'):
+            break
+    else:
+        return None
+    # The index is a TIFF IFD, with offsets relative to its header:
+    start += 4
+    tiff = payload[4:]
+    if tiff[:2] not in (b'II', b'MM'):
+        return None
+    endian = '<' if tiff[:2] == b'II' else '>'
+    try:
+        ifd = struct.unpack(endian + 'I', tiff[4:8])[0]
+        count = struct.unpack(endian + 'H', tiff[ifd : ifd + 2])[0]
+        for i in range(count):
+            tag, type, length, value = struct.unpack(endian + 'HHII', tiff[ifd + 2 + 12 * i : ifd + 14 + 12 * i])
+            if tag != 0xb002: # MP Entry
+                continue
+            frames = []
+            for entry in range(value, value + length, 16):
+                attributes, size, offset = struct.unpack(endian + 'III', tiff[entry : entry + 12])
+                # The first image starts at the start of the file, and the
+                # others are relative to the MPF header in the first image:
+                frames.append((offset and start + offset, size))
+            return frames
+    except struct.error:
+        pass
+    return None
+
+def eye_jpeg_sources(image, data, filename):
+    '''
+    Returns a list of (jpeg data, x offset) for each eye of an opened JPEG or
+    MPO image, where x offset is where the eye starts in that JPEG, or None
+    if the images in an MPO file can't be found. As in get_image_eye(), files
+    without a stereo extension use the first image for both eyes.
+    '''
+    if not stereo_image.is_stereo_image_extension(filename):
+        return [ (data, 0), (data, 0) ]
+    if image.format == 'MPO' and getattr(image, 'n_frames', 1) > 1:
+        frames = mpo_frames(data)
+        if frames is None or len(frames) < 2:
+            return None
+        return [ (data[offset : offset + size], 0) for offset, size in frames[:2] ]
+    if stereo_image.is_side_by_side(image, filename):
+        # Cross-eyed, the left eye is on the right hand side:
+        return [ (data, image.width // 2), (data, 0) ]
+    return [ (data, 0), (data, 0) ]
+
+def snap(value, step, tolerance):
+    snapped = int(round(float(value) / step)) * step
+    if abs(snapped - value) > tolerance:
+        return None
+    return snapped
+
+def plan_lossless_crop(adj, eye_size, mcu, eye_x=(0, 0), tolerance=default_snap_tolerance):
+    '''
+    Works out whether the adjustments can be applied to a stereo image
+    without re-encoding. eye_size is the size of each eye, mcu the MCU size
+    and eye_x the offset of each eye in its JPEG. Returns None if not, or a
+    tuple of the width and height of each eye in the output, the (x, y) to
+    crop each eye from in its JPEG, and a copy of the adjustments with the
+    crop moved to the MCU boundaries.
+    '''
+    W, H = eye_size
+    h_offset = stereo_image.trim_horizontal_offsets_left(adj.calc_horizontal_offsets())
+    width = stereo_image.calc_final_image_width(adj.hcrop, h_offset, W)
+    height = int(round(stereo_image.calc_final_image_height(adj.vcrop, adj.vertical_alignment, H)))
+
+    # The right eye goes on the left, so the left eye has to be dropped in on
+    # an MCU boundary:
+    width = snap(width, mcu[0], tolerance)
+    if not width or height <= 0:
+        return None
+
+    origins = []
+    for eye_idx, eye_multiplier in ((0, -1.0), (1, 1.0)):
+        va = eye_multiplier * adj.vertical_alignment
+        x0 = adj.hcrop[eye_idx][0] * W
+        x1 = adj.hcrop[eye_idx][1] * W
+        y0 = (adj.vcrop[0] + max(va, 0)) * H
+        y1 = (adj.vcrop[1] + min(va, 0)) * H
+
+        # Any part of the output not covered by this eye would need to be
+        # filled in with the background colour:
+        if abs(h_offset[eye_idx] * W) > tolerance or \
+                abs(x1 - x0 - width) > tolerance or \
+                abs(y1 - y0 - height) > tolerance:
+            return None
+
+        x = snap(eye_x[eye_idx] + x0, mcu[0], tolerance)
+        y = snap(y0, mcu[1], tolerance)
+        if x is None or y is None:
+            return None
+        x0, y0 = x - eye_x[eye_idx], y
+        if x0 < 0 or y0 < 0 or x0 + width > W or y0 + height > H:
+            return None
+        origins.append((x0, y0))
+
+    # Adjustments that describe the crop that will actually be made:
+    (x0l, y0l), (x0r, y0r) = origins
+    snapped = stereo_image.Adjustments(
+            parallax = 100.0 * (x0l - x0r) / W,
+            vertical_alignment = float(y0r - y0l) / H,
+            vcrop = [float(min(y0l, y0r)) / H, float(max(y0l, y0r) + height) / H],
+            hcrop = [[float(x0) / W, float(x0 + width) / W] for x0, y0 in origins],
+            background = adj.background,
+            export_profile = adj.export_profile)
+
+    return width, height, [ (x0 + eye_x[i], y0) for i, (x0, y0) in enumerate(origins) ], snapped
+
+def lossless_plan(filename, data, adj, tolerance=default_snap_tolerance):
+    '''
+    Returns the opened image, the JPEG data and offset of each eye (see
+    eye_jpeg_sources) and the plan (see plan_lossless_crop) for saving the
+    image in data, loaded from filename, with these adjustments losslessly,
+    or None if it has to be re-encoded.
+    '''
+    image = Image.open(io.BytesIO(data))
+    if image.format not in ('JPEG', 'MPO'):
+        return None
+    sources = eye_jpeg_sources(image, data, filename)
+    if sources is None:
+        return None
+    eye_size = image.size
+    if stereo_image.is_side_by_side(image, filename):
+        eye_size = (image.width // 2, image.height)
+
+    # The images in an MPO file are encoded separately, and jpegtran can only
+    # drop one into the other if they have the same chroma subsampling:
+    mcu = [ mcu_size(d) for (d, x) in sources ]
+    if mcu[0] is None or mcu[0] != mcu[1]:
+        return None
+
+    plan = plan_lossless_crop(adj, eye_size, mcu[0],
+            [ x for (d, x) in sources ], tolerance)
+    if plan is None:
+        return None
+    return image, sources, plan
+
+def can_save_lossless(filename, adj, tolerance=default_snap_tolerance):
+    '''
+    Returns True if save_lossless would save the image without re-encoding it.
+    '''
+    if find_jpegtran() is None:
+        return False
+    with open(filename, 'rb') as f:
+        data = f.read()
+    return lossless_plan(filename, data, adj, tolerance) is not None
+
+def jpegtran(*args):
+    subprocess.check_call((find_jpegtran(), '-copy', 'none') + args)
+
+def jpeg_segment(marker, payload):
+    return struct.pack('>BBH', 0xff, marker, len(payload) + 2) + payload
+
+def insert_metadata(data, exif=None, icc_profile=None):
+    '''
+    Inserts EXIF data and an ICC profile (as found in Pillow's info
+    dictionary) into a JPEG file that doesn't have any, after the JFIF
+    header if there is one.
+    '''
+    segments = b''
+    if exif:
+        segments += jpeg_segment(0xe1, exif)
+    if icc_profile:
+        # Split over as many APP2 segments as necessary:
+        chunk_size = 65519
+        chunks = [ icc_profile[i : i + chunk_size] for i in range(0, len(icc_profile), chunk_size) ]
+        for i, chunk in enumerate(chunks):
+            segments += jpeg_segment(0xe2, b'ICC_PROFILE\0' + struct.pack('BB', i + 1, len(chunks)) + chunk)
+    pos = 2 # After SOI
+    if data[2:4] == b'\xff\xe0': # APP0
+        pos += 2 + struct.unpack('>H', data[4:6])[0]
+    return data[:pos] + segments + data[pos:]
+
+def save_lossless(filename, adj, jpg_filename, profile, tolerance=default_snap_tolerance):
+    '''
+    Saves the adjusted side by side image to jpg_filename with jpegtran if
+    possible, returning the adjustments that were applied after snapping to
+    the MCU boundaries. Returns None without writing anything if the image
+    has to be re-encoded instead. Only the settings of the export profile that
+    don't require re-encoding are applied.
+    '''
+    if find_jpegtran() is None:
+        return None
+
+    with open(filename, 'rb') as f:
+        data = f.read()
+    planned = lossless_plan(filename, data, adj, tolerance)
+    if planned is None:
+        return None
+    image, sources, (width, height, origins, snapped) = planned
+
+    tmp = tempfile.mkdtemp(prefix='stereo_cropper')
+    try:
+        cropped = []
+        for eye_idx, ((eye_data, eye_x), (x, y)) in enumerate(zip(sources, origins)):
+            src = os.path.join(tmp, 'eye%i-src.jpg' % eye_idx)
+            dst = os.path.join(tmp, 'eye%i.jpg' % eye_idx)
+            with open(src, 'wb') as f:
+                f.write(eye_data)
+            jpegtran('-crop', '%ix%i+%i+%i' % (width, height, x, y), '-outfile', dst, src)
+            cropped.append(dst)
+
+        # Widen the right eye to fit both, then drop the left eye in on the
+        # right hand side:
+        canvas = os.path.join(tmp, 'canvas.jpg')
+        jpegtran('-crop', '%ix%i+0+0' % (width * 2, height), '-outfile', canvas, cropped[1])
+        options = profile.jpegtran_options()
+        output = os.path.join(tmp, 'output.jpg')
+        jpegtran('-drop', '+%i+0' % width, cropped[0], '-outfile', output, *(options + [canvas]))
+        with open(output, 'rb') as f:
+            output_data = f.read()
+        if profile.keep_metadata:
+            # The metadata is copied from the source file rather than with
+            # jpegtran, which would also copy the MPO index:
+            output_data = insert_metadata(output_data, image.info.get('exif'), image.info.get('icc_profile'))
+    except (OSError, subprocess.CalledProcessError) as e:
+        print('Lossless crop of %s failed, re-encoding instead: %s' % (filename, str(e)))
+        return None
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    # Only written once jpegtran has succeeded, so that a failure leaves the
+    # output file (claimed, or from a previous export) for the re-encode:
+    with open(jpg_filename, 'wb') as f:
+        f.write(output_data)
+    return snapped
+
+# vi:et:sw=4:ts=4
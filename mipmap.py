@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+
+# Copyright 2016 Ian Munsie
+#
+# This file is part of the Stereo Cropping Tool.
+#
+# The Stereo Cropping Tool is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The Stereo Cropping Tool is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# The Stereo Cropping Tool. If not, see <http://www.gnu.org/licenses/>.
+
+# Generates mip chains for the eye textures with a 2x2 box filter, so that
+# zoomed out images are sampled from a texture close to the size they are
+# displayed at. This is plain numpy operating on height x width x channels
+# arrays, which may be views of locked texture levels, so it can be run and
+# benchmarked without a device:
+#
+#   python mipmap.py [WIDTHxHEIGHT]
+
+from __future__ import print_function
+
+import sys, time
+import numpy as np
+
+# Number of destination rows filtered at a time, which bounds the size of the
+# 16 bit temporaries:
+default_band_rows = 128
+
+def mip_level_count(width, height):
+    # Full chain down to 1x1, same as passing 0 levels to CreateTexture:
+    return max(width, height).bit_length()
+
+def mip_level_size(width, height, level):
+    return max(1, width >> level), max(1, height >> level)
+
+def downsample(src, out=None, band_rows=None):
+    '''
+    Halves the size of src (rounding down, but never smaller than 1) by
+    averaging each 2x2 block of pixels. With an odd dimension the last
+    row / column is dropped, matching the size Direct3D expects for the next
+    mip level. If out is passed the result is written directly into it.
+    '''
+    if band_rows is None:
+        band_rows = default_band_rows
+    height, width = src.shape[:2]
+    out_width, out_height = mip_level_size(width, height, 1)
+    if out is None:
+        out = np.empty((out_height, out_width) + src.shape[2:], np.uint8)
+
+    for y in range(0, out_height, band_rows):
+        rows = min(band_rows, out_height - y)
+        if height > 1:
+            top = src[y * 2     : (y + rows) * 2     : 2]
+            bot = src[y * 2 + 1 : (y + rows) * 2 + 1 : 2]
+            acc = np.add(top, bot, dtype=np.uint16)
+        else:
+            acc = src.astype(np.uint16) * 2
+        if width > 1:
+            acc = acc[:, 0 : out_width * 2 : 2] + acc[:, 1 : out_width * 2 : 2]
+        else:
+            acc *= 2
+        # Round to nearest:
+        acc += 2
+        acc >>= 2
+        out[y : y + rows] = acc
+    return out
+
+def mip_chain(base, band_rows=None):
+    '''
+    Yields each successively smaller mip level of base, not including base.
+    '''
+    level = base
+    while level.shape[0] > 1 or level.shape[1] > 1:
+        level = downsample(level, band_rows=band_rows)
+        yield level
+
+def benchmark(width, height, repeat=5):
+    from PIL import Image
+
+    print('Generating %ix%i test image...' % (width, height))
+    base = np.random.randint(0, 256, (height, width, 4)).astype(np.uint8)
+    levels = mip_level_count(width, height)
+
+    for band_rows in (32, default_band_rows, 512, height):
+        times = []
+        for i in range(repeat):
+            start = time.time()
+            chain = list(mip_chain(base, band_rows))
+            times.append(time.time() - start)
+        assert(len(chain) == levels - 1)
+        print('%-22s best %7.1f ms, mean %7.1f ms' % ('numpy %i row bands' % band_rows,
+            min(times) * 1000.0, sum(times) / len(times) * 1000.0))
+
+    # For comparison, Pillow's box filter on an RGB image of the same size:
+    image = Image.frombytes('RGB', (width, height), base[:,:,:3].tostring())
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        level = image
+        for l in range(1, levels):
+            level = level.resize(mip_level_size(width, height, l), Image.BOX)
+        times.append(time.time() - start)
+    print('%-22s best %7.1f ms, mean %7.1f ms' % ('Pillow resize BOX',
+        min(times) * 1000.0, sum(times) / len(times) * 1000.0))
+
+if __name__ == '__main__':
+    size = (6000, 4000)
+    if len(sys.argv) > 1:
+        size = map(int, sys.argv[1].split('x'))
+    benchmark(*size)
+
+# vi:et:sw=4:ts=4
@@ -0,0 +1,367 @@
+#!/usr/bin/env python
+
+# Copyright 2016 Ian Munsie
+#
+# This file is part of the Stereo Cropping Tool.
+#
+# The Stereo Cropping Tool is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The Stereo Cropping Tool is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# The Stereo Cropping Tool. If not, see <http://www.gnu.org/licenses/>.
+
+# Rules for grouping related files (an original photo and any cropped versions
+# of it) and picking which file of a group to open. These are shared between
+# next/prev navigation in the interactive tool and the batch exporter.
+
+import os, re, itertools, bisect, time
+
+# This set will be expanded to include the extension of any manually opened
+# files, so that next/prev will include any similar files:
+navigate_extensions = set(('.mpo', '.jps', '.spct', '.pns'))
+
+stereo_extensions = ('.mpo', '.jps', '.pns')
+
+file_prefix_pattern = re.compile(r'-cropped(?:-(?P<idx>[0-9]+))?')
+def file_prefix(filename):
+    name = os.path.basename(filename).lower()
+    name = os.path.splitext(name)[0]
+    match = file_prefix_pattern.search(name)
+    if match is not None:
+        return name[:match.start()]
+    return name
+
+def next_cropped_index(listing, prefix):
+    '''
+    Returns the number to save the next adjusted copy of the image with this
+    prefix as, given a listing of its directory: one more than the most
+    recent adjusted copy (<prefix>-cropped-N), or 0 for <prefix>-cropped if
+    there are none.
+    '''
+    highest = -1
+    for name in listing:
+        name = os.path.splitext(name.lower())[0]
+        if not name.startswith(prefix):
+            continue
+        match = file_prefix_pattern.search(name)
+        if match is None or match.start() != len(prefix):
+            continue
+        highest = max(highest, int(match.group('idx') or 0))
+    return highest + 1
+
+def file_supported(filename):
+    return os.path.splitext(filename)[1].lower() in navigate_extensions
+
+def group_files(files):
+    '''
+    Sorts a list of filenames into groups of related files sharing the same
+    filename prefix. Returns a list of (prefix, files) tuples.
+    '''
+    files = filter(file_supported, files)
+    files = sorted(files, key=file_prefix)
+    # Remember - don't convert the result of groupby to a list prematurely
+    # or internal iterators will be useless:
+    return [(group, list(file_group)) for (group, file_group) in itertools.groupby(files, file_prefix)]
+
+# A directory modified within this many seconds of being listed may be modified
+# again without its modification time changing (FAT only has a 2 second
+# resolution), so it is listed again on the next refresh to be sure:
+racy_interval = 2.0
+
+class DirectoryIndex(object):
+    '''
+    The groups of related files in a directory, with the prefixes kept sorted
+    for quick next / previous lookups. refresh() only lists the directory again
+    if its modification time has changed (or navigate_extensions has grown),
+    and then only regroups the files that were added or removed.
+    '''
+    def __init__(self, dirname):
+        self.dirname = dirname
+        self.files = set()
+        self.groups = {} # prefix -> list of (rank, filename), highest priority first
+        self.prefixes = [] # Sorted
+        self.mtime = None
+        self.extensions = None
+        self.racy = False
+        self.scans = 0
+
+    def _add(self, filename):
+        prefix = file_prefix(filename)
+        entry = (file_rank(filename), filename)
+        group = self.groups.get(prefix)
+        if group is None:
+            self.groups[prefix] = [entry]
+            return prefix
+        bisect.insort(group, entry)
+
+    def _remove(self, filename):
+        prefix = file_prefix(filename)
+        group = self.groups[prefix]
+        group.remove((file_rank(filename), filename))
+        if not group:
+            del self.groups[prefix]
+            return prefix
+
+    def refresh(self, listing=None):
+        '''
+        Updates the index if the directory has changed. listing may be passed
+        if the caller has already listed the directory.
+        '''
+        mtime = os.stat(self.dirname).st_mtime
+        extensions = frozenset(navigate_extensions)
+        if mtime == self.mtime and extensions == self.extensions and not self.racy:
+            return
+        if listing is None:
+            listing = os.listdir(self.dirname)
+        if extensions != self.extensions:
+            self.__init__(self.dirname)
+
+        files = set(f for f in listing if os.path.splitext(f)[1].lower() in extensions)
+        removed = [ self._remove(f) for f in self.files - files ]
+        added = [ self._add(f) for f in files - self.files ]
+        removed = [ p for p in removed if p is not None ]
+        added = [ p for p in added if p is not None ]
+        if len(added) + len(removed) > 64:
+            self.prefixes = sorted(self.groups)
+        else:
+            for prefix in removed:
+                del self.prefixes[bisect.bisect_left(self.prefixes, prefix)]
+            for prefix in added:
+                bisect.insort(self.prefixes, prefix)
+
+        self.files = files
+        self.mtime = mtime
+        self.extensions = extensions
+        self.racy = time.time() - mtime < racy_interval
+        self.scans += 1
+
+    def neighbours(self, prefix):
+        '''
+        Returns the prefixes of the groups either side of prefix, wrapping
+        around at either end. prefix does not need to be in the index.
+        '''
+        n = len(self.prefixes)
+        i = bisect.bisect_left(self.prefixes, prefix)
+        j = i
+        if i < n and self.prefixes[i] == prefix:
+            j += 1
+        return self.prefixes[(i - 1) % n], self.prefixes[j % n]
+
+    def group(self, prefix):
+        '''
+        Returns the files in a group, highest priority first.
+        '''
+        return [ filename for (rank, filename) in self.groups[prefix] ]
+
+    def __iter__(self):
+        '''
+        Yields (prefix, files) for each group, in the same order as
+        group_files(), with the files in each group highest priority first.
+        '''
+        for prefix in self.prefixes:
+            yield prefix, self.group(prefix)
+
+_indexes = {}
+
+def directory_index(dirname, listing=None):
+    '''
+    Returns the up to date index of a directory, which is kept between calls
+    so that it only has to be updated when the directory changes.
+    '''
+    key = os.path.abspath(dirname)
+    index = _indexes.get(key)
+    if index is None:
+        index = _indexes[key] = DirectoryIndex(key)
+    index.refresh(listing)
+    return index
+
+def find_prev_next_file(filename):
+    dirname = os.path.dirname(os.path.join(os.curdir, filename))
+    index = directory_index(dirname)
+    prev, next = index.neighbours(file_prefix(filename))
+    prev = [ os.path.join(dirname, x) for x in index.group(prev) ]
+    next = [ os.path.join(dirname, x) for x in index.group(next) ]
+    return (prev, next)
+
+def file_rank(filename):
+    '''
+    Returns a tuple that sorts files so the highest priority will be first.
+    Files must already have been reduced to a set of related files (same
+    filename prefix) and that can be opened by this tool. Previously cropped
+    files take priority over uncropped files (the highest -cropped-N first,
+    then -cropped), then .spct files take priority over .jps, .pns or .mpo
+    files, which take priority over anything else.
+    '''
+    name = os.path.basename(filename)
+    match = file_prefix_pattern.search(name)
+    idx = None
+    if match is not None:
+        idx = match.group('idx')
+    ext = os.path.splitext(name)[1].lower()
+    return (match is None,
+            idx is None,
+            -int(idx or 0),
+            ext != '.spct',
+            ext not in stereo_extensions,
+            # No real policy from this point onwards, resort to alphabetical.
+            # We could maybe prioritise .mpo over .jps, but it's not clear
+            # that would always be the correct answer.
+            name)
+
+def highest_priority_file(files):
+    return min(files, key=file_rank)
+
+def find_spct_files(top):
+    '''
+    Walks a directory tree and yields the .spct file that navigation would
+    open for each group of related files, skipping groups where that would be
+    an image that has never been adjusted.
+    '''
+    for dirpath, dirnames, filenames in os.walk(top):
+        dirnames.sort()
+        for group, files in directory_index(dirpath, filenames):
+            # The index already has each group in priority order:
+            filename = os.path.join(dirpath, files[0])
+            if os.path.splitext(filename)[1].lower() == '.spct':
+                yield filename
+
+def find_unadjusted_images(top):
+    '''
+    Walks a directory tree and yields every stereo image that has not been
+    adjusted yet, i.e. where navigation would open the image itself.
+    '''
+    for dirpath, dirnames, filenames in os.walk(top):
+        dirnames.sort()
+        for group, files in directory_index(dirpath, filenames):
+            filename = files[0]
+            if os.path.splitext(filename)[1].lower() in stereo_extensions and \
+                    file_prefix_pattern.search(filename.lower()) is None:
+                yield os.path.join(dirpath, filename)
+
+# The comparison function file_rank() replaced, kept to check it against:
+def legacy_file_cmp(a, b):
+    '''
+    Comparison function to sort files so the highest priority will be
+    first. Files must already have been reduced to a set of related files
+    (same filename prefix) and that can be opened by this tool. Previously
+    cropped files take priority over uncropped files, and .spct files
+    will take priority over .jps, .pns or .mpo files.
+    '''
+    # Check for previously cropped files:
+    match_a = file_prefix_pattern.search(a)
+    match_b = file_prefix_pattern.search(b)
+    if match_a is not None and match_b is None:
+        return -1
+    if match_a is None and match_b is not None:
+        return 1
+    if match_a is not None and match_b is not None:
+        # Both files were previously cropped, the one with the highest
+        # index takes priority:
+        idx_a  = match_a.group('idx')
+        idx_b  = match_b.group('idx')
+        if idx_a is None and idx_b is not None:
+            return 1
+        if idx_a is not None and idx_b is None:
+            return -1
+        if idx_a is not None and idx_b is not None:
+            # Higher index takes priority, so reverse sort:
+            result = -cmp(int(idx_a), int(idx_b))
+            if result:
+                return result
+            # Index on both files is the same, continue with other
+            # comparisons
+
+    # Prioritise .spct files over anything else:
+    ext_a = os.path.splitext(a)[1].lower()
+    ext_b = os.path.splitext(b)[1].lower()
+    if ext_a == '.spct' and ext_b != '.spct':
+        return -1
+    if ext_a != '.spct' and ext_b == '.spct':
+        return 1
+
+    # Prioritise stereo images over anything else:
+    if ext_a in stereo_extensions and ext_b not in stereo_extensions:
+        return -1
+    if ext_a not in stereo_extensions and ext_b in stereo_extensions:
+        return 1
+
+    # No real policy from this point onwards, resort to alphabetical. We
+    # could maybe prioritise .mpo over .jps, but it's not clear that would
+    # always be the correct answer.
+    return cmp(a, b)
+
+def benchmark(num_groups, files_per_group=3, steps=1000):
+    import tempfile, shutil
+
+    tmp = tempfile.mkdtemp(prefix='stereo_cropper')
+    try:
+        print('Creating %i files...' % (num_groups * files_per_group))
+        for i in range(num_groups):
+            for name in ('IMG_%05i.MPO', 'IMG_%05i-cropped.jps', 'IMG_%05i-cropped.spct')[:files_per_group]:
+                open(os.path.join(tmp, name % i), 'w').close()
+        filename = os.path.join(tmp, 'IMG_%05i.MPO' % (num_groups // 2))
+
+        def legacy(filename):
+            # What find_prev_next_file used to do for every step:
+            dirname = os.path.dirname(filename)
+            file_groups = group_files(os.listdir(dirname))
+            cur_group = file_prefix(filename)
+            cur_idx = 0
+            for i, (group, file_group) in enumerate(file_groups):
+                if group == cur_group:
+                    cur_idx = i
+            prev = file_groups[(cur_idx - 1) % len(file_groups)][1]
+            next = file_groups[(cur_idx + 1) % len(file_groups)][1]
+            return ([ os.path.join(dirname, x) for x in prev ],
+                    [ os.path.join(dirname, x) for x in next ])
+
+        def legacy_highest_priority_file(files):
+            return sorted(files, cmp=legacy_file_cmp)[0]
+
+        for name, fn, choose in (
+                ('listdir + sort', legacy, legacy_highest_priority_file),
+                ('DirectoryIndex', find_prev_next_file, highest_priority_file)):
+            start = time.time()
+            f = filename
+            for i in range(steps):
+                f = choose(fn(f)[1])
+            print('%-16s %7.3f ms per step' % (name, (time.time() - start) * 1000.0 / steps))
+        print('Directory listed %i times by the index' % directory_index(tmp).scans)
+    finally:
+        shutil.rmtree(tmp)
+
+def check_file_rank(trials=100000):
+    # Compares the highest priority file chosen from random groups of related
+    # file names against the comparison function it replaced:
+    import random
+
+    def random_name():
+        name = 'IMG_0001'
+        if random.random() < 0.7:
+            name += random.choice(('-cropped', '-CROPPED', '-cropped-%i' % random.randint(0, 12),
+                '-cropped-0%i' % random.randint(0, 12)))
+        return name + random.choice(('.mpo', '.MPO', '.jps', '.pns', '.spct', '.SPCT', '.jpg', '.png'))
+
+    for i in range(trials):
+        files = list(set(os.path.join('photos', random_name()) for j in range(random.randint(1, 8))))
+        expected = sorted(files, cmp=legacy_file_cmp)[0]
+        assert highest_priority_file(files) == expected, (files, expected)
+        assert min(files, key=file_rank) == expected
+    print('file_rank agrees with legacy_file_cmp for %i random groups' % trials)
+
+if __name__ == '__main__':
+    import sys
+    num_groups = 5000
+    if len(sys.argv) > 1:
+        num_groups = int(sys.argv[1])
+    check_file_rank()
+    benchmark(num_groups, steps=200)
+
+# vi:et:sw=4:ts=4
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+
+# Copyright 2016 Ian Munsie
+#
+# This file is part of the Stereo Cropping Tool.
+#
+# The Stereo Cropping Tool is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The Stereo Cropping Tool is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# The Stereo Cropping Tool. If not, see <http://www.gnu.org/licenses/>.
+
+# Writes PNG files one band of rows at a time, so that the whole image never
+# has to be in memory at once. Pillow can only encode a complete image. Rows
+# are filtered with the same per row heuristic as libpng (the filter with the
+# smallest sum of absolute differences), vectorised over the band with numpy.
+#
+#   python png_writer.py [WIDTHxHEIGHT]
+
+from __future__ import print_function
+
+import sys, time, struct, zlib
+import numpy as np
+
+# Number of bytes of pixels filtered at a time, which bounds the size of the
+# temporaries:
+default_band_size = 1024 * 1024
+
+color_types = {
+    # mode: (PNG colour type, bytes per pixel)
+    'L': (0, 1),
+    'LA': (4, 2),
+    'RGB': (2, 3),
+    'RGBA': (6, 4),
+}
+
+def is_supported_mode(mode):
+    return mode in color_types
+
+def write_chunk(f, chunk_type, data):
+    f.write(struct.pack('>I', len(data)))
+    f.write(chunk_type)
+    f.write(data)
+    f.write(struct.pack('>I', zlib.crc32(chunk_type + data) & 0xffffffff))
+
+def filter_rows(rows, prev, bpp):
+    '''
+    Filters a height x row_bytes array of rows, given the row before them (or
+    zeros for the first row of the image). Returns the filtered rows as a
+    height x (1 + row_bytes) array with the filter type in the first column.
+    '''
+    raw = rows.astype(np.int16)
+    above = np.vstack((prev.astype(np.int16)[np.newaxis], raw[:-1]))
+    left = np.zeros_like(raw)
+    left[:, bpp:] = raw[:, :-bpp]
+    upleft = np.zeros_like(raw)
+    upleft[:, bpp:] = above[:, :-bpp]
+
+    p = left + above - upleft
+    pa = np.abs(p - left)
+    pb = np.abs(p - above)
+    pc = np.abs(p - upleft)
+    paeth = np.where((pa <= pb) & (pa <= pc), left, np.where(pb <= pc, above, upleft))
+    del p, pa, pb, pc
+
+    candidates = np.empty((5,) + raw.shape, np.uint8)
+    candidates[0] = rows
+    candidates[1] = (raw - left) & 0xff
+    candidates[2] = (raw - above) & 0xff
+    candidates[3] = (raw - ((left + above) >> 1)) & 0xff
+    candidates[4] = (raw - paeth) & 0xff
+
+    # Sum of the absolute values as signed bytes:
+    cost = np.abs(candidates.view(np.int8).astype(np.int32)).sum(axis=2)
+    best = cost.argmin(axis=0)
+
+    out = np.empty((rows.shape[0], rows.shape[1] + 1), np.uint8)
+    out[:, 0] = best
+    out[:, 1:] = candidates[best, np.arange(rows.shape[0])]
+    return out
+
+def write_png(f, size, mode, bands, compress_level=6, icc_profile=None, band_size=None):
+    '''
+    Writes a PNG image of the given size and mode (L, LA, RGB or RGBA) to the
+    file object f. bands is an iterable of raw pixel data (e.g. from Pillow's
+    tobytes()) for successive bands of whole rows, which must add up to the
+    height of the image.
+    '''
+    if band_size is None:
+        band_size = default_band_size
+    width, height = size
+    color_type, bpp = color_types[mode]
+    row_bytes = width * bpp
+    filter_rows_per_pass = max(1, band_size // row_bytes)
+
+    f.write(b'\x89PNG\r\n\x1a\n')
+    write_chunk(f, b'IHDR', struct.pack('>IIBBBBB', width, height, 8, color_type, 0, 0, 0))
+    if icc_profile:
+        write_chunk(f, b'iCCP', b'ICC Profile\0\0' + zlib.compress(icc_profile))
+
+    compressor = zlib.compressobj(compress_level)
+    prev = np.zeros(row_bytes, np.uint8)
+    written = 0
+    for data in bands:
+        band = np.frombuffer(data, np.uint8).reshape(-1, row_bytes)
+        for y in range(0, band.shape[0], filter_rows_per_pass):
+            rows = band[y : y + filter_rows_per_pass]
+            compressed = compressor.compress(filter_rows(rows, prev, bpp).tostring())
+            if compressed:
+                write_chunk(f, b'IDAT', compressed)
+            prev = rows[-1]
+        written += band.shape[0]
+    assert(written == height)
+
+    write_chunk(f, b'IDAT', compressor.flush())
+    write_chunk(f, b'IEND', b'')
+
+def benchmark(width, height):
+    import io
+    from PIL import Image
+
+    print('Generating %ix%i test image...' % (width, height))
+    # Something more compressible than noise, like a photo:
+    x = np.linspace(0, 255, width).astype(np.uint8)
+    y = np.linspace(0, 255, height).astype(np.uint8)
+    pixels = np.empty((height, width, 3), np.uint8)
+    pixels[:,:,0] = x[np.newaxis]
+    pixels[:,:,1] = y[:,np.newaxis]
+    pixels[:,:,2] = np.random.randint(0, 16, (height, width))
+    image = Image.frombytes('RGB', (width, height), pixels.tostring())
+    del pixels
+
+    start = time.time()
+    pillow = io.BytesIO()
+    image.save(pillow, format='PNG')
+    print('%-10s %7.1f ms, %8i bytes' % ('Pillow', (time.time() - start) * 1000.0, len(pillow.getvalue())))
+
+    start = time.time()
+    streamed = io.BytesIO()
+    band_rows = 64
+    bands = (image.crop((0, y, width, min(y + band_rows, height))).tobytes()
+            for y in range(0, height, band_rows))
+    write_png(streamed, image.size, image.mode, bands)
+    print('%-10s %7.1f ms, %8i bytes' % ('Streamed', (time.time() - start) * 1000.0, len(streamed.getvalue())))
+
+    streamed.seek(0)
+    assert(Image.open(streamed).tobytes() == image.tobytes())
+
+if __name__ == '__main__':
+    size = (6000, 2000)
+    if len(sys.argv) > 1:
+        size = map(int, sys.argv[1].split('x'))
+    benchmark(*size)
+
+# vi:et:sw=4:ts=4
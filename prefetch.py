@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+
+# Copyright 2016 Ian Munsie
+#
+# This file is part of the Stereo Cropping Tool.
+#
+# The Stereo Cropping Tool is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The Stereo Cropping Tool is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# The Stereo Cropping Tool. If not, see <http://www.gnu.org/licenses/>.
+
+# Decodes the images either side of the current image into the image cache on
+# a background thread, so that moving to the next / previous image only has to
+# upload the textures. Pillow releases the GIL while decoding, so this runs
+# alongside the UI.
+
+from __future__ import print_function
+
+import threading
+
+import stereo_image
+
+class Prefetcher(object):
+    def __init__(self, cache=stereo_image.eye_cache, on_loaded=None):
+        self.cache = cache
+        self.on_loaded = on_loaded # Called on the prefetch thread with the eyes
+        self.cond = threading.Condition()
+        self.queue = []    # Filenames waiting to be decoded
+        self.busy = None   # Filename currently being decoded
+        self.thread = threading.Thread(target=self.run, name='Prefetcher')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def prefetch(self, filenames):
+        '''
+        Replaces the list of files to be decoded into the cache ahead of time.
+        '''
+        with self.cond:
+            self.queue = [ f for f in filenames if f != self.busy ]
+            self.cond.notify_all()
+
+    def wait(self, filename):
+        '''
+        Called before loading filename. If it is being decoded right now this
+        waits for it to finish rather than decoding it twice, and if it is
+        still waiting to be decoded it is dropped from the queue since the
+        caller is about to decode it anyway.
+        '''
+        with self.cond:
+            if filename in self.queue:
+                self.queue.remove(filename)
+            while self.busy == filename:
+                self.cond.wait()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.queue:
+                    self.cond.wait()
+                filename = self.busy = self.queue.pop(0)
+
+            eyes = None
+            try:
+                # Images too large for the cache are not kept in it, so the
+                # eyes are also passed to on_loaded:
+                eyes = stereo_image.load_stereo_image(filename, self.cache)
+            except Exception as e:
+                # Not fatal - it will be reported if the user navigates to it
+                print('Unable to prefetch %s: %s' % (filename, str(e)))
+
+            with self.cond:
+                self.busy = None
+                self.cond.notify_all()
+
+            if self.on_loaded is not None:
+                self.on_loaded(filename, eyes)
+
+# vi:et:sw=4:ts=4
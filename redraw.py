@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+
+# Copyright 2016 Ian Munsie
+#
+# This file is part of the Stereo Cropping Tool.
+#
+# The Stereo Cropping Tool is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The Stereo Cropping Tool is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# The Stereo Cropping Tool. If not, see <http://www.gnu.org/licenses/>.
+
+# Decides when the window actually needs to be rendered again, so that the
+# main loop can sleep until something happens instead of rendering the same
+# frame as fast as possible. This knows nothing about Windows or Direct3D, so
+# it can be exercised with a fake device:
+#
+#   python redraw.py
+
+from __future__ import print_function
+
+class RedrawTracker(object):
+    '''
+    Compares a snapshot of everything that affects the rendered frame against
+    the snapshot the last frame was rendered with. The snapshot can be any
+    value that compares equal when nothing has changed, but must not share
+    anything mutable with the caller (e.g. use tuples instead of lists).
+    Changes that can't be seen in the snapshot, such as the window being
+    uncovered or the device being reset, are reported with invalidate().
+    '''
+    def __init__(self):
+        self.state = None
+        self.invalid = True
+        self.redraws = self.skipped = 0
+
+    def invalidate(self):
+        self.invalid = True
+
+    def needs_redraw(self, state):
+        return self.invalid or state != self.state
+
+    def update(self, state):
+        '''
+        Returns True if a frame needs to be rendered for state, assuming the
+        caller will then render it.
+        '''
+        if not self.needs_redraw(state):
+            self.skipped += 1
+            return False
+        self.state = state
+        self.invalid = False
+        self.redraws += 1
+        return True
+
+    def __str__(self):
+        return 'Rendered %i frames, skipped %i' % (self.redraws, self.skipped)
+
+class FakeDevice(object):
+    def __init__(self):
+        self.presents = 0
+
+    def Present(self):
+        self.presents += 1
+
+def simulate():
+    # A short session: the image is displayed, sits idle, is zoomed a few
+    # times, sits idle, the window is uncovered, then the user drags the
+    # mouse without changing anything (e.g. while in crop mode with no
+    # buttons held) before adjusting the parallax:
+    device = FakeDevice()
+    tracker = RedrawTracker()
+    view = {'scale': 1.0, 'parallax': 0.0, 'hcrop': [[0.0, 1.0], [0.0, 1.0]]}
+
+    def state():
+        return (view['scale'], view['parallax'], tuple(map(tuple, view['hcrop'])))
+
+    def frame():
+        if tracker.update(state()):
+            device.Present()
+
+    events = [None] * 100
+    events += ['zoom'] * 5 + [None] * 100 + ['uncover'] + ['move'] * 50 + ['parallax'] * 10 + ['crop']
+    for event in events:
+        if event == 'zoom':
+            view['scale'] *= 1.1
+        elif event == 'uncover':
+            tracker.invalidate()
+        elif event == 'parallax':
+            view['parallax'] += 0.1
+        elif event == 'crop':
+            # Modified in place, which the snapshot must still notice:
+            view['hcrop'][0][0] += 0.01
+        frame()
+
+    print('%i events, %i frames presented' % (len(events), device.presents))
+    print(tracker)
+    assert(device.presents == 1 + 5 + 1 + 10 + 1)
+
+if __name__ == '__main__':
+    simulate()
+
+# vi:et:sw=4:ts=4
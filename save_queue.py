@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+
+# Copyright 2016 Ian Munsie
+#
+# This file is part of the Stereo Cropping Tool.
+#
+# The Stereo Cropping Tool is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The Stereo Cropping Tool is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# The Stereo Cropping Tool. If not, see <http://www.gnu.org/licenses/>.
+
+# Saves adjusted images on a background thread, so that moving to the next
+# image doesn't have to wait for the crop and JPEG encode of the previous one.
+
+from __future__ import print_function
+
+import threading, Queue
+
+import stereo_image
+
+# Number of saves that may be waiting before save() blocks. Each waiting save
+# may need its image decoded again if it has dropped out of the image cache,
+# so this is kept small:
+default_max_pending = 2
+
+class SaveQueue(object):
+    def __init__(self, max_pending=default_max_pending, cache=stereo_image.eye_cache, prefetcher=None):
+        self.cache = cache
+        self.prefetcher = prefetcher # Waited on before decoding an image
+        self.queue = Queue.Queue(max_pending)
+        self.lock = threading.Lock()
+        self.failed = [] # (filename, exception) for every save that failed
+        self.thread = threading.Thread(target=self.run, name='SaveQueue')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def save(self, filename, adj):
+        '''
+        Queues the stereo image loaded from filename to be saved with a copy
+        of the adjustments as they are now. Blocks if max_pending saves are
+        already waiting.
+        '''
+        self.queue.put((filename, adj.copy()))
+
+    def flush(self):
+        '''
+        Waits for all queued saves to finish, returning the list of
+        (filename, exception) for any saves that failed since the last flush.
+        '''
+        self.queue.join()
+        with self.lock:
+            failed, self.failed = self.failed, []
+        return failed
+
+    def run(self):
+        while True:
+            filename, adj = self.queue.get()
+            try:
+                # The image being saved is often the one the prefetcher was
+                # decoding to display at full resolution:
+                if self.prefetcher is not None:
+                    self.prefetcher.wait(filename)
+                # If the image has to be decoded to save it, it is usually
+                # still in the cache from when it was displayed:
+                stereo_image.save_adjusted_image(None, filename, adj, cache=self.cache)
+            except Exception as e:
+                print('Unable to save %s: %s' % (filename, str(e)))
+                with self.lock:
+                    self.failed.append((filename, e))
+            finally:
+                self.queue.task_done()
+
+# vi:et:sw=4:ts=4
@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+
+# Copyright 2016 Ian Munsie
+#
+# This file is part of the Stereo Cropping Tool.
+#
+# The Stereo Cropping Tool is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The Stereo Cropping Tool is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# The Stereo Cropping Tool. If not, see <http://www.gnu.org/licenses/>.
+
+# Reading and writing .spct files. Every file is validated when it is loaded,
+# so that a hand edited or truncated file is reported as an SpctError naming
+# the problem rather than failing later on with a KeyError or TypeError in
+# the middle of an export.
+#
+#   python spct.py FILE_OR_DIRECTORY...
+#
+# checks every .spct file given or found under the directories.
+
+from __future__ import print_function
+
+import sys, os, math, json, numbers, time
+from multiprocessing.pool import ThreadPool
+
+import stereo_image
+
+# The version written to new files. Files with the same major version can
+# always be read, as minor versions may only add optional keys.
+file_version = '1.0'
+
+# Upgrades for files from older major versions, as {major: function}, where
+# each function takes the parsed JSON and returns it in the format of the
+# next major version. There have been no incompatible changes yet.
+migrations = {}
+
+# Reading a .spct file is mostly waiting on the disk, or the network for a
+# share, so many can be read at once:
+default_threads = 16
+
+def major_version(version):
+    try:
+        return int(str(version).split('.')[0])
+    except ValueError:
+        raise stereo_image.SpctError('Invalid file version %r' % version)
+
+def migrate(spct_json):
+    '''
+    Upgrades parsed JSON from an older version of the file format to the
+    current version, raising SpctError if it is not a version we can read.
+    '''
+    version = major_version(spct_json.get('file_version'))
+    current = major_version(file_version)
+    while version < current and version in migrations:
+        spct_json = migrations[version](spct_json)
+        version += 1
+    if version != current:
+        raise stereo_image.SpctError('Unsupported file version %s' % spct_json.get('file_version'))
+    return spct_json
+
+def check_number(spct_json, key):
+    value = spct_json[key]
+    if not isinstance(value, numbers.Real) or isinstance(value, bool) \
+            or math.isinf(value) or math.isnan(value):
+        raise stereo_image.SpctError('%s is not a number: %r' % (key, value))
+    return float(value)
+
+def check_range(value, name):
+    # A crop is a pair of fractions of the image size, left <= right:
+    if not isinstance(value, list) or len(value) != 2 \
+            or not all(isinstance(v, numbers.Real) and not isinstance(v, bool) for v in value) \
+            or not 0.0 <= value[0] <= value[1] <= 1.0:
+        raise stereo_image.SpctError('Invalid %s: %r' % (name, value))
+    return (float(value[0]), float(value[1]))
+
+export_record_types = {
+    'source_sha1': basestring,
+    'source_size': (int, long),
+    'source_mtime': numbers.Real,
+    'params': basestring,
+    'output_size': (int, long),
+}
+
+def check_export_record(record):
+    # The export record is only there to skip unnecessary exports, so one
+    # that is invalid is dropped rather than making the file unreadable:
+    if not isinstance(record, dict):
+        return None
+    for key, types in export_record_types.items():
+        if not isinstance(record.get(key), types):
+            return None
+    return dict((key, record[key]) for key in export_record_types)
+
+class SpctDocument(object):
+    '''
+    The contents of a .spct file: the source image (relative to the directory
+    of the .spct file), the adjustments to apply to it, and the export record
+    of the image saved alongside it (see export_record), if any. Tens of
+    thousands of these may be held at once when scanning an archive, so they
+    are kept compact, with the crops as tuples. Use adjustments() to get a
+    copy that can be edited.
+    '''
+    __slots__ = ('source', 'parallax', 'vertical_alignment', 'vcrop', 'hcrop',
+            'background', 'export_profile', 'export')
+
+    def __init__(self, source, parallax, vertical_alignment, vcrop, hcrop, background,
+            export_profile=None, export=None):
+        self.source = source
+        self.parallax = parallax
+        self.vertical_alignment = vertical_alignment
+        self.vcrop = vcrop
+        self.hcrop = hcrop
+        self.background = background
+        self.export_profile = export_profile
+        self.export = export
+
+    @classmethod
+    def from_json(cls, spct_json, dirname=''):
+        '''
+        Validates parsed JSON, which may be from any supported version of the
+        file format, raising SpctError if anything is missing or invalid.
+        '''
+        if not isinstance(spct_json, dict):
+            raise stereo_image.SpctError('Not a .spct file')
+        spct_json = migrate(spct_json)
+        missing = [ key for key in ('filename', 'parallax', 'vertical_alignment',
+                'vertical_crop', 'horizontal_crop', 'background') if key not in spct_json ]
+        if missing:
+            raise stereo_image.SpctError('Missing %s' % ', '.join(missing))
+
+        filename = spct_json['filename']
+        if not isinstance(filename, basestring) or not filename:
+            raise stereo_image.SpctError('Invalid source filename: %r' % filename)
+        hcrop = spct_json['horizontal_crop']
+        if not isinstance(hcrop, list) or len(hcrop) != 2:
+            raise stereo_image.SpctError('Invalid horizontal_crop: %r' % hcrop)
+        background = spct_json['background']
+        if not isinstance(background, (int, long)) or isinstance(background, bool) \
+                or not 0 <= background <= 0xffffff:
+            raise stereo_image.SpctError('Invalid background: %r' % background)
+        export_profile = spct_json.get('export_profile')
+        if export_profile is not None and not isinstance(export_profile, basestring):
+            raise stereo_image.SpctError('Invalid export_profile: %r' % export_profile)
+
+        return cls(
+                source = os.path.join(dirname, filename),
+                parallax = check_number(spct_json, 'parallax'),
+                vertical_alignment = check_number(spct_json, 'vertical_alignment'),
+                vcrop = check_range(spct_json['vertical_crop'], 'vertical_crop'),
+                hcrop = tuple(check_range(h, 'horizontal_crop') for h in hcrop),
+                background = int(background),
+                export_profile = export_profile,
+                export = check_export_record(spct_json.get('export')))
+
+    @classmethod
+    def load(cls, filename):
+        '''
+        Loads a .spct file. Raises IOError if it can't be read, or SpctError
+        if it is not a valid .spct file.
+        '''
+        with open(filename, 'r') as f:
+            data = f.read()
+        try:
+            spct_json = json.loads(data)
+        except ValueError as e:
+            raise stereo_image.SpctError('Invalid JSON: %s' % str(e))
+        return cls.from_json(spct_json, os.path.dirname(filename))
+
+    @classmethod
+    def from_adjustments(cls, source, adj, export=None):
+        return cls(source, adj.parallax, adj.vertical_alignment, tuple(adj.vcrop),
+                tuple(tuple(h) for h in adj.hcrop), adj.background, adj.export_profile,
+                export)
+
+    def adjustments(self):
+        return stereo_image.Adjustments(self.parallax, self.vertical_alignment,
+                list(self.vcrop), [list(h) for h in self.hcrop], self.background,
+                self.export_profile)
+
+    def to_json(self):
+        spct_json = {
+            'file_version': file_version,
+            'filename': os.path.basename(self.source),
+            'parallax': self.parallax,
+            'vertical_alignment': self.vertical_alignment,
+            'vertical_crop': list(self.vcrop),
+            'horizontal_crop': [list(h) for h in self.hcrop],
+            'background': self.background,
+        }
+        if self.export_profile is not None:
+            spct_json['export_profile'] = self.export_profile
+        if self.export is not None:
+            spct_json['export'] = self.export
+        return spct_json
+
+    def save(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.to_json(), f)
+
+def load_one(filename):
+    # Runs on the pool threads, so must not raise:
+    try:
+        return filename, SpctDocument.load(filename), None
+    except (IOError, OSError, stereo_image.SpctError) as e:
+        return filename, None, str(e)
+
+def load_many(filenames, threads=None):
+    '''
+    Loads many .spct files in parallel, yielding (filename, document, error)
+    in the same order as filenames, where document is None and error is the
+    reason if a file could not be loaded.
+    '''
+    if threads is None:
+        threads = default_threads
+    filenames = list(filenames)
+    if threads <= 1 or len(filenames) <= 1:
+        for filename in filenames:
+            yield load_one(filename)
+        return
+    pool = ThreadPool(min(threads, len(filenames)))
+    try:
+        for result in pool.imap(load_one, filenames, chunksize=16):
+            yield result
+    finally:
+        pool.terminate()
+
+def main():
+    filenames = []
+    for path in sys.argv[1:]:
+        if os.path.isdir(path):
+            for dirpath, dirnames, names in os.walk(path):
+                filenames.extend(os.path.join(dirpath, name) for name in sorted(names)
+                        if os.path.splitext(name)[1].lower() == '.spct')
+        else:
+            filenames.append(path)
+
+    start = time.time()
+    failed = 0
+    for filename, document, error in load_many(filenames):
+        if error is not None:
+            print('%s: %s' % (filename, error), file=sys.stderr)
+            failed += 1
+    print('%i .spct files checked, %i invalid in %.1f seconds' %
+            (len(filenames), failed, time.time() - start))
+    if failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
+
+# vi:et:sw=4:ts=4
@@ -20,8 +20,7 @@
 from __future__ import print_function
 
 import sys, os
-import ctypes, struct, math, itertools, re, json
-import numpy as np
+import ctypes
 from collections import namedtuple
 import Tkinter, tkFileDialog
 
@@ -31,8 +30,20 @@ from directx.d3d import IDirect3DVertexBuffer9, IDirect3DTexture9
 
 from nvapi import *
 
+import stereo_image
+import auto_align
+import stereo_window
+import navigation
+from prefetch import Prefetcher
+from redraw import RedrawTracker
+from save_queue import SaveQueue
+import texture_upload
+import mipmap
+import tiles
+import export_profiles
+from navigation import navigate_extensions
+
 import PIL
-from PIL import Image
 # Ensure this is a recent version of the pillow fork with support for stereo .mpo files
 # Haven't checked which version it was introduced in, don't really care either.
 assert(hasattr(PIL, 'PILLOW_VERSION') and map(int, PIL.PILLOW_VERSION.split('.')) >= [3, 3, 0])
@@ -49,10 +60,6 @@ backgrounds = (
     #0x7c8084, # Cool gray
 )
 
-# This set will be expanded to include the extension of any manually opened
-# files, so that next/prev will include any similar files:
-navigate_extensions = set(('.mpo', '.jps', '.spct', '.pns'))
-
 # Custom vertex and it's FVF code. This is outdated tech for fixed pipeline, we
 # might change it later.
 class Vertex(Structure):
@@ -138,6 +145,15 @@ ImageRect = namedtuple('ImageRect', ['x', 'y', 'w', 'h', 'u1', 'v1', 'u2', 'v2']
 def saturate(n):
     return min(max(n, 0.0), 1.0)
 
+class D3DTileBackend(tiles.TileBackend):
+    def __init__(self, frame):
+        self.frame = frame
+
+    def create_tile(self, image):
+        # The tile pyramid already has a level for each power of two, so the
+        # tiles themselves don't need mipmaps:
+        return self.frame.image_to_texture(image, mipmaps=False)
+
 # The Frame class from the util module is not an ideal fit for my needs, but it
 # will work and will save time so I'll use it for now.
 class CropTool(Frame):
@@ -147,6 +163,15 @@ class CropTool(Frame):
         self.output_format = OUTPUT_FORMAT.NV3D
         self.check_output_format()
         self.swap_eyes = False
+        self.mipmaps = True
+        self.redraw = RedrawTracker()
+        self.needs_render = True
+        self.prefetcher = Prefetcher(on_loaded=self.prefetch_finished)
+        self.window_checker = stereo_window.WindowChecker(on_checked=self.window_checked)
+        self.check_window = False
+        self.window_state = None
+        self.window_description = None
+        self.save_queue = SaveQueue(prefetcher=self.prefetcher)
         return Frame.__init__(self, *a, **kw)
 
     def reinit(self, filename):
@@ -159,75 +184,98 @@ class CropTool(Frame):
         self.vertical_alignment = 0.0
         self.vcrop = [0.0, 1.0]
         self.hcrop = [[0.0, 1.0], [0.0, 1.0]]
+        self.export_profile = None
         self.dirty = False
+        self.full_resolution_eyes = None # (filename, eyes) from the prefetcher
+
+    def image_to_texture(self, image, mipmaps=None):
+        if mipmaps is None:
+            mipmaps = self.mipmaps
+        levels = 1
+        if mipmaps:
+            levels = mipmap.mip_level_count(image.width, image.height)
 
-    def image_to_texture(self, image):
         texture = POINTER(IDirect3DTexture9)()
         # Seems we must use a 32bpp format for hardware support:
-        self.device.CreateTexture(image.width, image.height, 1, 0, D3DFORMAT.X8R8G8B8, D3DPOOL.MANAGED, byref(texture), None)
+        self.device.CreateTexture(image.width, image.height, levels, 0, D3DFORMAT.X8R8G8B8, D3DPOOL.MANAGED, byref(texture), None)
 
         rect = D3DLOCKED_RECT()
         texture.LockRect(0, byref(rect), None, D3DLOCK.DISCARD)
 
-        # Convert B8G8R8 -> X8R8G8B8, using numpy for speed and directly using
-        # the destination buffer to minimise excess copies. This seems to be
-        # significantly faster than even using self.LoadTexture / D3DX, so
-        # that's an unexpected win:
-        np_src_buf = np.frombuffer(image.tobytes(), np.uint8).reshape(image.width * image.height, 3)
-        dst_buf = (c_uint8 * image.width * image.height * 4).from_address(rect.pBits)
-        np_dst_buf = np.frombuffer(dst_buf, np.uint8).reshape(image.width * image.height, 4)
-        np_dst_buf[:,:-1] = np_src_buf[:,[2,1,0]]
+        # Convert B8G8R8 -> X8R8G8B8 directly into the destination buffer.
+        # This seems to be significantly faster than even using
+        # self.LoadTexture / D3DX, so that's an unexpected win:
+        texture_upload.upload_image(image, rect.pBits, rect.Pitch)
+
+        # Each mip level is filtered straight from the previous level while
+        # both are locked, so no other copies of the image are needed:
+        width, height = image.size
+        for level in range(1, levels):
+            prev_pixels = texture_upload.pitched_pixels(rect.pBits, rect.Pitch, width, height)
+            width, height = mipmap.mip_level_size(image.width, image.height, level)
+            prev_rect, rect = rect, D3DLOCKED_RECT()
+            texture.LockRect(level, byref(rect), None, D3DLOCK.DISCARD)
+            mipmap.downsample(prev_pixels, texture_upload.pitched_pixels(rect.pBits, rect.Pitch, width, height))
+            texture.UnlockRect(level - 1)
 
-        texture.UnlockRect(0)
+        texture.UnlockRect(levels - 1)
 
         return texture
 
-    def is_stereo_image_extension(self):
-        return os.path.splitext(self.filename)[1].lower() in ('.jps', '.pns')
-
-    def get_image_eye(self, eye):
-        if not self.is_stereo_image_extension():
-            self.image_height = self.image.height
-            self.image_width = self.image.width
-            return self.image
-
-        self.image_height = self.image.height
-        if self.image.format == 'MPO':
-            self.image.seek(eye == 1)
-            self.image_width = self.image.width
-            return self.image
-        elif self.image.format in ('JPEG', 'PNG'):
-            self.image_width = self.image.width / 2
-            x = 0
-            if eye != 1:
-                x = self.image_width
-            return self.image.crop((x, 0, x + self.image_width, self.image_height))
-        else:
-            print('Unsupported image type: %s' % self.image.format)
-            sys.exit(1)
+    def eyes_to_textures(self, eyes):
+        # Images too large for the device to create a texture of, such as
+        # stitched panoramas, are displayed as a pyramid of tiles instead:
+        if tiles.TiledImage.needs_tiling(eyes[0], *self.max_texture_size):
+            backend = D3DTileBackend(self)
+            return tuple(tiles.TiledImage(eye, backend) for eye in eyes)
+        return tuple(self.image_to_texture(eye) for eye in eyes)
 
-    def load_stereo_image(self, filename):
-        self.image = Image.open(filename)
+    def toggle_mipmaps(self):
+        self.mipmaps = not self.mipmaps
+        self.texture = self.eyes_to_textures(self.eyes)
 
-        texture_l = self.image_to_texture(self.get_image_eye(0))
-        texture_r = self.image_to_texture(self.get_image_eye(1))
+    def load_stereo_image(self, filename):
+        # If the prefetcher has already decoded the image we can use it,
+        # otherwise decode a reduced resolution draft sized to the window to
+        # display immediately, and the full resolution image will be decoded
+        # in the background and swapped in by check_full_resolution(). If the
+        # prefetcher is decoding it right now we wait for it rather than
+        # decoding it twice:
+        self.prefetcher.wait(filename)
+        draft_size = (self.presentparams.BackBufferWidth, self.presentparams.BackBufferHeight)
+        try:
+            self.eyes, self.full_resolution = stereo_image.load_draft_stereo_image(filename, draft_size)
+        except stereo_image.UnsupportedImageError as e:
+            print(str(e))
+            sys.exit(1)
+        # The crop, pan and parallax calculations are all relative to the
+        # full resolution image, regardless of the size of the textures:
+        self.image_width, self.image_height = stereo_image.get_eye_size(filename)
 
         # FIXME: Read parallax tag from *second image's* EXIF info - this does
         # not seem to be available in Pillow yet.
 
-        return texture_l, texture_r
+        return self.eyes_to_textures(self.eyes)
 
     def load_spct(self, filename):
-        spct_json = json.load(open(filename, 'r'))
-        if spct_json['file_version'] != '1.0':
-            print('Unsupported file version %s' % spct_json.file_version)
-            self.Quit()
-        self.filename = os.path.join(os.path.dirname(filename), spct_json['filename'])
-        self.parallax = spct_json['parallax']
-        self.vertical_alignment = spct_json['vertical_alignment']
-        self.vcrop = spct_json['vertical_crop']
-        self.hcrop = spct_json['horizontal_crop']
-        self.background = spct_json['background']
+        try:
+            self.filename, adj = stereo_image.load_spct(filename)
+        except stereo_image.SpctError as e:
+            print('%s: %s' % (filename, str(e)))
+            sys.exit(1)
+        except IOError as e:
+            print(str(e))
+            sys.exit(1)
+        self.parallax = adj.parallax
+        self.vertical_alignment = adj.vertical_alignment
+        self.vcrop = adj.vcrop
+        self.hcrop = adj.hcrop
+        self.background = adj.background
+        self.export_profile = export_profiles.available_profile(adj.export_profile)
+
+    def adjustments(self):
+        return stereo_image.Adjustments(self.parallax, self.vertical_alignment,
+                self.vcrop, self.hcrop, self.background, self.export_profile)
 
     def load_image(self):
         extension = os.path.splitext(self.filename)[1].lower()
@@ -244,87 +292,122 @@ class CropTool(Frame):
         # Load both images from the MPO file into a pair of textures:
         self.texture = self.load_stereo_image(self.filename)
 
+        # Images that have not been adjusted yet start with the estimated
+        # parallax, which doesn't count as a modification by itself:
+        if extension != '.spct':
+            self.auto_align()
+
+        self.prefetch_neighbours()
+
+    def swap_in_full_resolution(self, eyes):
+        self.eyes = eyes
+        self.full_resolution = True
+        self.texture = self.eyes_to_textures(eyes)
+
+    def check_full_resolution(self):
+        # Swap in the full resolution image once it has been decoded. Images
+        # too large for the cache, such as stitched panoramas, are handed
+        # over by the prefetcher instead:
+        if self.full_resolution:
+            return
+        decoded = self.full_resolution_eyes
+        if decoded is not None and decoded[0] == self.filename:
+            self.full_resolution_eyes = None
+            self.swap_in_full_resolution(decoded[1])
+            return
+        if self.filename not in stereo_image.eye_cache:
+            return
+        eyes = stereo_image.eye_cache.get(self.filename)
+        if eyes is not None:
+            self.swap_in_full_resolution(eyes)
+
+    def prefetch_neighbours(self):
+        # Start decoding the images that Page Up / Page Down will open in the
+        # background while the user is looking at this one, after the full
+        # resolution version of this image if only a draft is displayed:
+        filenames = []
+        if not self.full_resolution:
+            filenames.append(self.filename)
+        for files in self.find_prev_next_file():
+            try:
+                filenames.append(stereo_image.resolve_source(self.highest_priority_file(files)))
+            except (IOError, stereo_image.SpctError):
+                pass
+        self.prefetcher.prefetch(filenames)
+
+    def prefetch_finished(self, filename, eyes):
+        # Called on the prefetch thread - wake the main loop so it can swap
+        # in the full resolution image if it was waiting on one:
+        if not self.full_resolution:
+            if eyes is not None and filename == self.filename:
+                self.full_resolution_eyes = (filename, eyes)
+            self.WakeUp()
+
+    def auto_align(self):
+        # The estimates work just as well on the draft as the full image:
+        estimate = auto_align.estimate_adjustments(self.eyes)
+        adj, parallax_confidence, vertical_confidence = estimate
+        print('Estimated %s' % auto_align.describe_estimate(*estimate))
+        changed = False
+        if parallax_confidence >= auto_align.min_confidence:
+            self.parallax = adj.parallax
+            changed = True
+        if vertical_confidence >= auto_align.min_vertical_confidence:
+            self.vertical_alignment = adj.vertical_alignment
+            changed = True
+        return changed
+
+    def window_check_state(self):
+        # Everything that affects the stereo window check:
+        return (id(self.eyes), self.parallax, self.vertical_alignment,
+                tuple(self.vcrop), tuple(map(tuple, self.hcrop)))
+
+    def toggle_window_check(self):
+        self.check_window = not self.check_window
+        self.window_state = self.window_description = None
+        print('Stereo window check %s' % ('on' if self.check_window else 'off'))
+
+    def update_window_check(self):
+        # Queues a check whenever the adjustments change, which runs in the
+        # background and only the latest of which is checked if they are
+        # being dragged:
+        state = self.window_check_state()
+        if state != self.window_state:
+            self.window_state = state
+            self.window_checker.check(self.eyes, self.adjustments())
+
+    def window_checked(self, adj, reports):
+        # Called on the window checking thread:
+        description = stereo_window.describe(reports)
+        if self.check_window and description != self.window_description:
+            self.window_description = description
+            print(description)
+
+    def fix_stereo_window(self):
+        hcrop, reports = stereo_window.suggest_hcrop(stereo_window.reduce_eyes(self.eyes), self.adjustments())
+        if hcrop is None:
+            print(stereo_window.describe(reports))
+            if stereo_window.violations(reports):
+                print('Unable to fix by cropping forwards')
+            return False
+        print('Cropped forwards to %s: %s' % (stereo_window.describe_hcrop(hcrop), stereo_window.describe(reports)))
+        self.hcrop = hcrop
+        return True
+
     def calc_horizontal_offsets(self, right=0):
-        return (self.hcrop[0][right] - self.parallax / 200.0,
-                    self.hcrop[1][right] + self.parallax / 200.0)
+        return stereo_image.calc_horizontal_offsets(self.hcrop, self.parallax, right)
 
     def trim_horizontal_offsets_left(self, h_offset):
-        # Align one of the two images to the left of the final image.
-        # Do not modify the passed h_offset as it is still used to calculate
-        # the panning when fitting to window - return a new one.
-        if h_offset[0] < h_offset[1]:
-            return (0.0, h_offset[1] - h_offset[0])
-        return (h_offset[0] - h_offset[1], 0.0)
+        return stereo_image.trim_horizontal_offsets_left(h_offset)
 
     def calc_final_image_width(self, horizontal_offsets):
-        # Calculate the width taking cropping and parallax into account. The
-        # width will be the maximum required for the two images, but no more -
-        # one of the images should be aligned to the right.
-        # FIXME: There is still a minor off by one error that might result in a
-        # single black column on the right of an image that shouldn't be there,
-        # depending on floating point rounding.
-        return int(math.ceil(max(self.hcrop[0][1] - self.hcrop[0][0] + horizontal_offsets[0], self.hcrop[1][1] - self.hcrop[1][0] + horizontal_offsets[1]) * self.image_width))
+        return stereo_image.calc_final_image_width(self.hcrop, horizontal_offsets, self.image_width)
 
     def save_adjusted_image(self):
-        base_filename = os.path.join(os.path.dirname(self.filename), self.file_prefix(self.filename)) + '-cropped'
-        extension = os.path.splitext(self.filename)[1]
-        if extension.lower() == '.png':
-            extension = '.pns'
-        elif extension.lower() not in ('.jps', '.pns'):
-            extension = '.jps'
-        jpg_filename = base_filename + extension
-        spct_filename = base_filename + '.spct'
-        i = 0
-        while os.path.exists(jpg_filename):
-            i += 1
-            jpg_filename = base_filename + '-%d%s' % (i, extension)
-            spct_filename = base_filename + '-%d.spct' % i
-        print('Saving %s + %s...' % (jpg_filename, spct_filename))
-
-        spct_json = {
-            'file_version': '1.0',
-            'filename': os.path.basename(self.filename),
-            'parallax': self.parallax,
-            'vertical_alignment': self.vertical_alignment,
-            'vertical_crop': self.vcrop,
-            'horizontal_crop': self.hcrop,
-            'background': self.background,
-        }
-        json.dump(spct_json, open(spct_filename, 'w'))
-
-        h_offset = self.calc_horizontal_offsets()
-        h_offset = self.trim_horizontal_offsets_left(h_offset)
-        width = self.calc_final_image_width(h_offset)
-        height = (self.vcrop[1] - self.vcrop[0] - abs(self.vertical_alignment)) * self.image_height
-
-        byteswapped_background = struct.unpack('<I', struct.pack('>I', self.background))[0] >> 8
-        new_img = Image.new(self.image.mode, (width * 2, int(round(height))), byteswapped_background)
-
-        for eye_idx, eye_multiplier in ((0, -1.0), (1, 1.0)):
-            # Vertical alignment
-            adj = eye_multiplier * self.vertical_alignment
-            adj1 = adj2 = 0
-            if adj > 0:
-                adj1 = adj
-            else:
-                adj2 = adj
-
-            # Left image goes on the right:
-            side_off = 0
-            if eye_idx == 0:
-                side_off = width
-
-            image = self.get_image_eye(eye_idx)
-            cropped = image.crop((
-                self.hcrop[eye_idx][0] * image.width,
-                (self.vcrop[0] + adj1) * image.height,
-                self.hcrop[eye_idx][1] * image.width,
-                (self.vcrop[1] + adj2) * image.height))
-            new_img.paste(cropped, (side_off + int(round(h_offset[eye_idx] * image.width)), 0))
-            cropped.close()
-
-        new_img.save(jpg_filename, format='JPEG')
-        new_img.close()
+        # Saved in the background so the next image can be loaded straight
+        # away. The full resolution image is decoded by the save queue if it
+        # is not already in the cache:
+        self.save_queue.save(self.filename, self.adjustments())
         self.dirty = False
 
     def OnCreateDevice(self):
@@ -338,6 +421,10 @@ class CropTool(Frame):
                 nv3d = False
                 self.check_output_format()
 
+        caps = D3DCAPS9()
+        self.device.GetDeviceCaps(byref(caps))
+        self.max_texture_size = (caps.MaxTextureWidth, caps.MaxTextureHeight)
+
         self.load_image()
 
         # Create two vertex buffers for the images in each eye. Later we might
@@ -349,6 +436,15 @@ class CropTool(Frame):
         self.device.CreateVertexBuffer(sizeof(Vertex) * 4, 0, 0,
             D3DPOOL.MANAGED, byref(self.vbuffer[1]), None)
 
+    def OnClose(self):
+        failed = self.save_queue.flush()
+        if failed:
+            print('WARNING: %i image(s) failed to save:' % len(failed))
+            for filename, e in failed:
+                print('  %s: %s' % (filename, str(e)))
+        print(stereo_image.eye_cache)
+        print(self.redraw)
+
     def OnDestroyDevice(self):
         del self.texture
         del self.vbuffer
@@ -372,7 +468,7 @@ class CropTool(Frame):
         h_offset = self.trim_horizontal_offsets_left(h_offset_l)
         w = self.calc_final_image_width(h_offset)
 
-        h = (self.vcrop[1] - self.vcrop[0] - abs(self.vertical_alignment)) * self.image_height
+        h = stereo_image.calc_final_image_height(self.vcrop, self.vertical_alignment, self.image_height)
         a = w / h
         if a > res_a:
             self.scale = float(self.presentparams.BackBufferWidth) / w
@@ -391,6 +487,12 @@ class CropTool(Frame):
     def cycle_background_colours(self):
         self.background = backgrounds[(backgrounds.index(self.background) + 1) % len(backgrounds)]
 
+    def cycle_export_profiles(self):
+        names = export_profiles.profile_names()
+        current = export_profiles.get_profile(self.export_profile).name
+        self.export_profile = names[(names.index(current) + 1) % len(names)]
+        print('Export profile: %s' % self.export_profile)
+
     def check_output_format(self):
         if not nv3d and self.output_format == OUTPUT_FORMAT.NV3D:
             self.output_format += 1
@@ -399,92 +501,11 @@ class CropTool(Frame):
         self.output_format = (self.output_format + 1) % OUTPUT_FORMAT.NUM
         self.check_output_format()
 
-    file_prefix_pattern = re.compile(r'-cropped(?:-(?P<idx>[0-9]+))?')
-    def file_prefix(self, filename):
-        name = os.path.basename(filename).lower()
-        name = os.path.splitext(name)[0]
-        match = self.file_prefix_pattern.search(name)
-        if match is not None:
-            return name[:match.start()]
-        return name
-
     def find_prev_next_file(self):
-        def file_supported(filename):
-            return os.path.splitext(filename)[1].lower() in navigate_extensions
-
-        dirname = os.path.dirname(os.path.join(os.curdir, self.filename))
-        files = os.listdir(dirname)
-        files = filter(file_supported, files)
-        files = sorted(files, key=self.file_prefix)
-        # Remember - don't convert the result of groupby to a list prematurely
-        # or internal iterators will be useless:
-        files = itertools.groupby(files, self.file_prefix)
-        cur_group = self.file_prefix(self.filename)
-        cur_idx = 0
-        file_groups = []
-        for i, (group, file_group) in enumerate(files):
-            file_groups.append(list(file_group))
-            if group == cur_group:
-                cur_idx = i
-        prev = file_groups[(cur_idx - 1) % len(file_groups)]
-        next = file_groups[(cur_idx + 1) % len(file_groups)]
-        prev = map(lambda x: os.path.join(dirname, x), prev)
-        next = map(lambda x: os.path.join(dirname, x), next)
-        return (prev, next)
+        return navigation.find_prev_next_file(self.filename)
 
     def highest_priority_file(self, files):
-        def file_cmp(a, b):
-            '''
-            Comparison function to sort files so the highest priority will be
-            first. Files must already have been reduced to a set of related files
-            (same filename prefix) and that can be opened by this tool. Previously
-            cropped files take priority over uncropped files, and .spct files
-            will take priority over .jps, .pns or .mpo files.
-            '''
-            # Check for previously cropped files:
-            match_a = self.file_prefix_pattern.search(a)
-            match_b = self.file_prefix_pattern.search(b)
-            if match_a is not None and match_b is None:
-                return -1
-            if match_a is None and match_b is not None:
-                return 1
-            if match_a is not None and match_b is not None:
-                # Both files were previously cropped, the one with the highest
-                # index takes priority:
-                idx_a  = match_a.group('idx')
-                idx_b  = match_b.group('idx')
-                if idx_a is None and idx_b is not None:
-                    return 1
-                if idx_a is not None and idx_b is None:
-                    return -1
-                if idx_a is not None and idx_b is not None:
-                    # Higher index takes priority, so reverse sort:
-                    result = -cmp(int(idx_a), int(idx_b))
-                    if result:
-                        return result
-                    # Index on both files is the same, continue with other
-                    # comparisons
-
-            # Prioritise .spct files over anything else:
-            ext_a = os.path.splitext(a)[1].lower()
-            ext_b = os.path.splitext(b)[1].lower()
-            if ext_a == '.spct' and ext_b != '.spct':
-                return -1
-            if ext_a != '.spct' and ext_b == '.spct':
-                return 1
-
-            # Prioritise stereo images over anything else:
-            stereo_extensions = ('.mpo', '.jps', '.pns')
-            if ext_a in stereo_extensions and ext_b not in stereo_extensions:
-                return -1
-            if ext_a not in stereo_extensions and ext_b in stereo_extensions:
-                return 1
-
-            # No real policy from this point onwards, resort to alphabetical. We
-            # could maybe prioritise .mpo over .jps, but it's not clear that would
-            # always be the correct answer.
-            return cmp(a, b)
-        return sorted(files, cmp=file_cmp)[0]
+        return navigation.highest_priority_file(files)
 
     def open_prev_file(self):
         if self.dirty:
@@ -519,10 +540,22 @@ class CropTool(Frame):
                 self.save_adjusted_image()
             elif wParam == ord('B'):
                 self.cycle_background_colours()
+            elif wParam == ord('E'):
+                self.cycle_export_profiles()
             elif wParam == ord('O'):
                 self.cycle_output_formats()
             elif wParam == ord('I'):
                 self.swap_eyes = not self.swap_eyes
+            elif wParam == ord('M'):
+                self.toggle_mipmaps()
+            elif wParam == ord('A'):
+                if self.auto_align():
+                    self.dirty = True
+            elif wParam == ord('W'):
+                self.toggle_window_check()
+            elif wParam == ord('R'):
+                if self.fix_stereo_window():
+                    self.dirty = True
             elif wParam in MODES.hold_keys:
                 self.mode = MODES.hold_keys[wParam]
             elif wParam == 0x21: # Page Up
@@ -682,38 +715,99 @@ class CropTool(Frame):
 
         return ImageRect(x, y, w, h, u1, v1, u2, v2)
 
-    def update_vertex_buffer_eye(self, vbuffer, r):
-        # Update the vertex buffer with the vertex positions and texture
-        # coordinates that correspond to the current paralax and crop
-        ptr = c_void_p()
-        vbuffer.Lock(0, 0, byref(ptr), 0)
-
+    def quad_vertices(self, r):
         # Path of least resistance to switch to untranslated coordinates:
         def x(x):
             return x / self.presentparams.BackBufferWidth * 2.0 - 1.0
         def y(y):
             return y / self.presentparams.BackBufferHeight * 2.0 - 1.0
 
-        data = (Vertex * 4)(
+        return (Vertex * 4)(
             #              X            Y     Z     U     V
             Vertex(x(r.x    ), -y(r.y    ), 1.0, r.u1, r.v1),
             Vertex(x(r.x+r.w), -y(r.y    ), 1.0, r.u2, r.v1),
             Vertex(x(r.x    ), -y(r.y+r.h), 1.0, r.u1, r.v2),
             Vertex(x(r.x+r.w), -y(r.y+r.h), 1.0, r.u2, r.v2),
         )
-        ctypes.memmove(ptr, data, sizeof(Vertex) * 4)
+
+    def update_vertex_buffer_eye(self, vbuffer, r):
+        # Update the vertex buffer with the vertex positions and texture
+        # coordinates that correspond to the current paralax and crop
+        ptr = c_void_p()
+        vbuffer.Lock(0, 0, byref(ptr), 0)
+        ctypes.memmove(ptr, self.quad_vertices(r), sizeof(Vertex) * 4)
         vbuffer.Unlock()
 
+    def view_state(self):
+        # Everything that affects the rendered frame. Copied into tuples since
+        # the crop lists are modified in place. The textures are compared by
+        # identity, which covers loading a new image, swapping in the full
+        # resolution image and toggling mipmaps:
+        return (self.scale, self.pan, self.parallax, self.vertical_alignment,
+                tuple(self.vcrop), tuple(map(tuple, self.hcrop)),
+                self.background, self.output_format, self.swap_eyes,
+                self.mipmaps, self.texture, self.image_width, self.image_height,
+                self.presentparams.BackBufferWidth, self.presentparams.BackBufferHeight)
+
+    def OnInvalidate(self):
+        self.redraw.invalidate()
+
+    def NeedsRender(self):
+        return self.needs_render
+
     def OnUpdate(self):
+        self.check_full_resolution()
+        if self.check_window:
+            self.update_window_check()
+        self.needs_render = self.redraw.update(self.view_state())
+        if not self.needs_render:
+            return
         self.rect = self.calc_rect(-1), self.calc_rect(1)
         self.update_vertex_buffer_eye(self.vbuffer[0], self.rect[0])
         self.update_vertex_buffer_eye(self.vbuffer[1], self.rect[1])
 
     def render_eye(self, eye_idx):
+        if isinstance(self.texture[eye_idx], tiles.TiledImage):
+            return self.render_tiled_eye(eye_idx)
         self.device.SetStreamSource(0, self.vbuffer[eye_idx], 0, sizeof(Vertex))
         self.device.SetTexture(0, self.texture[eye_idx])
         self.device.DrawPrimitive(D3DPT.TRIANGLESTRIP, 0, 2)
 
+    def render_tiled_eye(self, eye_idx):
+        r = self.rect[eye_idx]
+        if r.w <= 0 or r.h <= 0:
+            return
+
+        # Work out which part of the image is on screen, in texture
+        # coordinates, so only the tiles covering that need to be resident:
+        du = (r.u2 - r.u1) / r.w
+        dv = (r.v2 - r.v1) / r.h
+        u1 = r.u1 + max(0.0, -r.x) * du
+        v1 = r.v1 + max(0.0, -r.y) * dv
+        u2 = r.u2 - max(0.0, r.x + r.w - self.presentparams.BackBufferWidth) * du
+        v2 = r.v2 - max(0.0, r.y + r.h - self.presentparams.BackBufferHeight) * dv
+        if u1 >= u2 or v1 >= v2:
+            return
+
+        # The eyes may still be the reduced resolution draft:
+        tiled = self.texture[eye_idx]
+        scale = self.scale * self.image_width / tiled.width
+
+        for texture, (tu1, tv1, tu2, tv2) in tiled.visible_tiles(scale, u1, v1, u2, v2):
+            # Clip the tile to the visible part of the image, then map that
+            # back to screen coordinates and the tile's texture coordinates:
+            cu1, cv1 = max(tu1, u1), max(tv1, v1)
+            cu2, cv2 = min(tu2, u2), min(tv2, v2)
+            x1 = r.x + (cu1 - r.u1) / du
+            y1 = r.y + (cv1 - r.v1) / dv
+            x2 = r.x + (cu2 - r.u1) / du
+            y2 = r.y + (cv2 - r.v1) / dv
+            tile_rect = ImageRect(x1, y1, x2 - x1, y2 - y1,
+                    (cu1 - tu1) / (tu2 - tu1), (cv1 - tv1) / (tv2 - tv1),
+                    (cu2 - tu1) / (tu2 - tu1), (cv2 - tv1) / (tv2 - tv1))
+            self.device.SetTexture(0, texture)
+            self.device.DrawPrimitiveUP(D3DPT.TRIANGLESTRIP, 2, self.quad_vertices(tile_rect), sizeof(Vertex))
+
     def render_3d_vision(self):
         for eye_idx, nveye in ((0, STEREO_ACTIVE_EYE.LEFT), (1, STEREO_ACTIVE_EYE.RIGHT)):
             NvAPI.Stereo_SetActiveEye(self.stereo_handle, nveye)
@@ -753,6 +847,17 @@ class CropTool(Frame):
     def OnRender(self):
         self.device.SetRenderState(D3DRS.LIGHTING, False)
         self.device.SetFVF(VERTEXFVF)
+
+        # Trilinear filtering when zoomed out. Magnification is left as point
+        # sampling so individual pixels can be seen when zoomed in to line up
+        # the crop. Clamp so filtering doesn't wrap around to the other edge.
+        mipfilter = D3DTEXTUREFILTERTYPE.NONE
+        if self.mipmaps:
+            mipfilter = D3DTEXTUREFILTERTYPE.LINEAR
+        self.device.SetSamplerState(0, D3DSAMP.MINFILTER, D3DTEXTUREFILTERTYPE.LINEAR)
+        self.device.SetSamplerState(0, D3DSAMP.MIPFILTER, mipfilter)
+        self.device.SetSamplerState(0, D3DSAMP.ADDRESSU, D3DTADDRESS.CLAMP)
+        self.device.SetSamplerState(0, D3DSAMP.ADDRESSV, D3DTADDRESS.CLAMP)
         if self.output_format == OUTPUT_FORMAT.NV3D:
             self.render_3d_vision()
         else:
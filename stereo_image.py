@@ -0,0 +1,450 @@
+#!/usr/bin/env python
+
+# Copyright 2016 Ian Munsie
+#
+# This file is part of the Stereo Cropping Tool.
+#
+# The Stereo Cropping Tool is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The Stereo Cropping Tool is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# The Stereo Cropping Tool. If not, see <http://www.gnu.org/licenses/>.
+
+# Image loading, crop calculations and exporting of adjusted stereo images.
+# Nothing in here depends on Direct3D, NvAPI or a window, so this is shared
+# between the interactive tool and the headless batch exporter.
+
+from __future__ import print_function
+
+import os, io, math, struct, errno
+
+from PIL import Image
+
+from navigation import file_prefix, next_cropped_index
+from image_cache import EyeCache, file_signature
+import lossless_crop
+import png_writer
+import export_profiles
+import catalog
+import spct
+import export_record
+
+# Enough for the current image and both of its prefetched neighbours at 24MP:
+eye_cache = EyeCache(768 * 1024 * 1024)
+
+# Adjusted images are composed in bands of rows of about this many bytes:
+default_band_size = 4 * 1024 * 1024
+
+class UnsupportedImageError(Exception): pass
+class SpctError(Exception): pass
+
+def is_stereo_image_extension(filename):
+    return os.path.splitext(filename)[1].lower() in ('.mpo', '.jps', '.pns')
+
+def get_image_eye(image, filename, eye):
+    '''
+    Returns the image for one eye of a stereo image. Images that are not
+    stereo (judging by the filename extension) are returned as is for both
+    eyes. Side by side images use cross-eyed ordering, i.e. the left eye is on
+    the right hand side.
+    '''
+    if not is_stereo_image_extension(filename):
+        return image
+
+    if image.format == 'MPO':
+        image.seek(eye == 1)
+        return image
+    elif image.format in ('JPEG', 'PNG'):
+        width = image.width // 2
+        x = 0
+        if eye != 1:
+            x = width
+        return image.crop((x, 0, x + width, image.height))
+    raise UnsupportedImageError('Unsupported image type: %s' % image.format)
+
+def is_side_by_side(image, filename):
+    return is_stereo_image_extension(filename) and image.format != 'MPO'
+
+def get_eye_size(filename):
+    '''
+    Returns the full resolution size of one eye of a stereo image without
+    decoding it.
+    '''
+    image = Image.open(filename)
+    try:
+        width, height = image.size
+        if is_side_by_side(image, filename):
+            width //= 2
+        return width, height
+    finally:
+        image.close()
+
+def decode_stereo_image(filename, draft_size=None):
+    '''
+    Decodes both eyes of a stereo image, returning a list of two images. If
+    draft_size is passed JPEG based images will be decoded at a reduced scale
+    of 1/2, 1/4 or 1/8, whichever is the smallest that is still no smaller
+    than draft_size for each eye. This is several times faster than decoding
+    at full resolution, but note that other image types ignore draft_size.
+    '''
+    # Read the whole file up front so that we don't hold it open for as long
+    # as the decoded images are alive, which would stop other programs from
+    # replacing it on Windows:
+    with open(filename, 'rb') as f:
+        data = f.read()
+    image = Image.open(io.BytesIO(data))
+    eyes = []
+    for eye in (0, 1):
+        if eyes and image.format == 'MPO':
+            # Seeking to the next frame of an MPO decodes it into the same
+            # buffer as the previous frame, so each eye needs its own image:
+            image = Image.open(io.BytesIO(data))
+        if draft_size is not None and image.format in ('JPEG', 'MPO'):
+            if image.format == 'MPO' and is_stereo_image_extension(filename):
+                # Must seek before drafting, seeking resets the scale:
+                image.seek(eye == 1)
+            if is_side_by_side(image, filename):
+                image.draft(image.mode, (draft_size[0] * 2, draft_size[1]))
+            else:
+                image.draft(image.mode, draft_size)
+        eye_image = get_image_eye(image, filename, eye)
+        eye_image.load()
+        eyes.append(eye_image)
+    return eyes
+
+def load_stereo_image(filename, cache=eye_cache):
+    '''
+    Returns both eyes of a stereo image, from the cache if it has been decoded
+    recently and not modified since.
+    '''
+    eyes = cache.get(filename)
+    if eyes is None:
+        signature = file_signature(filename)
+        eyes = decode_stereo_image(filename)
+        cache.put(filename, eyes, signature)
+    return eyes
+
+def load_draft_stereo_image(filename, draft_size, cache=eye_cache):
+    '''
+    Returns both eyes of a stereo image for a quick preview, either at full
+    resolution from the cache, or decoded at a reduced resolution as
+    described in decode_stereo_image. Returns a tuple of the eyes and a flag
+    indicating whether they are at full resolution.
+    '''
+    eyes = cache.get(filename)
+    if eyes is not None:
+        return eyes, True
+    signature = file_signature(filename)
+    eyes = decode_stereo_image(filename, draft_size)
+    if eyes[0].size != get_eye_size(filename):
+        return eyes, False
+    # Draft mode had no effect, so we may as well cache them:
+    cache.put(filename, eyes, signature)
+    return eyes, True
+
+def calc_horizontal_offsets(hcrop, parallax, right=0):
+    return (hcrop[0][right] - parallax / 200.0,
+                hcrop[1][right] + parallax / 200.0)
+
+def trim_horizontal_offsets_left(h_offset):
+    # Align one of the two images to the left of the final image.
+    # Do not modify the passed h_offset as it is still used to calculate
+    # the panning when fitting to window - return a new one.
+    if h_offset[0] < h_offset[1]:
+        return (0.0, h_offset[1] - h_offset[0])
+    return (h_offset[0] - h_offset[1], 0.0)
+
+def calc_final_image_width(hcrop, horizontal_offsets, image_width):
+    # Calculate the width taking cropping and parallax into account. The
+    # width will be the maximum required for the two images, but no more -
+    # one of the images should be aligned to the right.
+    # FIXME: There is still a minor off by one error that might result in a
+    # single black column on the right of an image that shouldn't be there,
+    # depending on floating point rounding.
+    return int(math.ceil(max(hcrop[0][1] - hcrop[0][0] + horizontal_offsets[0], hcrop[1][1] - hcrop[1][0] + horizontal_offsets[1]) * image_width))
+
+def calc_final_image_height(vcrop, vertical_alignment, image_height):
+    return (vcrop[1] - vcrop[0] - abs(vertical_alignment)) * image_height
+
+class Adjustments(object):
+    '''
+    The parallax, alignment, crop and background that the user has applied to
+    a stereo image, and the name of the export profile to save it with (None
+    for the default). This is what gets saved in a .spct file.
+    '''
+    def __init__(self, parallax=0.0, vertical_alignment=0.0, vcrop=None, hcrop=None, background=0x000000,
+            export_profile=None):
+        self.parallax = parallax
+        self.vertical_alignment = vertical_alignment
+        self.vcrop = vcrop if vcrop is not None else [0.0, 1.0]
+        self.hcrop = hcrop if hcrop is not None else [[0.0, 1.0], [0.0, 1.0]]
+        self.background = background
+        self.export_profile = export_profile
+
+    def calc_horizontal_offsets(self, right=0):
+        return calc_horizontal_offsets(self.hcrop, self.parallax, right)
+
+    def copy(self):
+        # The crop lists are modified in place while the user is editing:
+        return Adjustments(self.parallax, self.vertical_alignment, list(self.vcrop),
+                [list(h) for h in self.hcrop], self.background, self.export_profile)
+
+def load_spct(filename):
+    '''
+    Loads a .spct file, returning the path to the source image it refers to
+    and the adjustments to apply to it. Raises SpctError if it is not a
+    valid .spct file.
+    '''
+    document = spct.SpctDocument.load(filename)
+    return document.source, document.adjustments()
+
+def resolve_source(filename):
+    '''
+    Returns the image that will be loaded when opening filename, which is the
+    source image for .spct files or filename itself for anything else.
+    '''
+    if os.path.splitext(filename)[1].lower() == '.spct':
+        return load_spct(filename)[0]
+    return filename
+
+def save_spct(filename, source, adj, export=None):
+    spct.SpctDocument.from_adjustments(source, adj, export).save(filename)
+
+def output_extension(filename):
+    extension = os.path.splitext(filename)[1]
+    if extension.lower() == '.png':
+        return '.pns'
+    elif extension.lower() not in ('.jps', '.pns'):
+        return '.jps'
+    return extension
+
+def claim_file(filename):
+    # Creates an empty file, unless it already exists, with the same
+    # permissions as open() would give it:
+    try:
+        os.close(os.open(filename, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o666))
+        return True
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+        return False
+
+def output_filenames(filename):
+    '''
+    Finds an unused pair of filenames to save an adjusted copy of filename
+    and its .spct file to, numbered after the most recent adjusted copy, and
+    claims them by creating both files empty. Another process saving a copy
+    of the same image at the same time will get a different pair.
+    '''
+    dirname = os.path.dirname(filename)
+    prefix = file_prefix(filename)
+    base_filename = os.path.join(dirname, prefix) + '-cropped'
+    extension = output_extension(filename)
+    # The directory only needs to be listed once, and when nothing else is
+    # saving to it the first pair tried is free:
+    i = next_cropped_index(os.listdir(dirname or os.curdir), prefix)
+    while True:
+        suffix = '-%d' % i if i else ''
+        jpg_filename = base_filename + suffix + extension
+        spct_filename = base_filename + suffix + '.spct'
+        if claim_file(jpg_filename):
+            if claim_file(spct_filename):
+                return jpg_filename, spct_filename
+            os.remove(jpg_filename)
+        i += 1
+
+def release_output_filenames(filenames):
+    # Removes claimed output files that were never written to:
+    for filename in filenames:
+        try:
+            if os.stat(filename).st_size == 0:
+                os.remove(filename)
+        except OSError:
+            pass
+
+def paired_output(spct_filename, source):
+    '''
+    Returns the adjusted image that was saved alongside a .spct file.
+    '''
+    return os.path.splitext(spct_filename)[0] + output_extension(source)
+
+def adjusted_image_layout(eyes, adj):
+    '''
+    Works out where each eye goes in the adjusted side by side image
+    (cross-eyed ordering). Returns the size of the image, the background
+    colour, and a list of (crop box, x position) for each eye. Raises
+    ValueError if the crop of either eye is empty.
+    '''
+    image_width, image_height = eyes[0].size
+
+    h_offset = adj.calc_horizontal_offsets()
+    h_offset = trim_horizontal_offsets_left(h_offset)
+    width = calc_final_image_width(adj.hcrop, h_offset, image_width)
+    height = calc_final_image_height(adj.vcrop, adj.vertical_alignment, image_height)
+
+    byteswapped_background = struct.unpack('<I', struct.pack('>I', adj.background))[0] >> 8
+
+    placements = []
+    for eye_idx, eye_multiplier in ((0, -1.0), (1, 1.0)):
+        # Vertical alignment
+        adj1 = adj2 = 0
+        va = eye_multiplier * adj.vertical_alignment
+        if va > 0:
+            adj1 = va
+        else:
+            adj2 = va
+
+        # Left image goes on the right:
+        side_off = 0
+        if eye_idx == 0:
+            side_off = width
+
+        eye = eyes[eye_idx]
+        # Rounded the same way Pillow's crop() would:
+        box = tuple(int(round(v)) for v in (
+            adj.hcrop[eye_idx][0] * eye.width,
+            (adj.vcrop[0] + adj1) * eye.height,
+            adj.hcrop[eye_idx][1] * eye.width,
+            (adj.vcrop[1] + adj2) * eye.height))
+        if box[2] <= box[0] or box[3] <= box[1]:
+            raise ValueError('The crop is empty')
+        placements.append((box, side_off + int(round(h_offset[eye_idx] * eye.width))))
+
+    return (width * 2, int(round(height))), byteswapped_background, placements
+
+def paste_adjusted_rows(dst, dst_y, eyes, placements, y, rows):
+    # Pastes output rows y to y + rows of each eye into dst at dst_y. Only
+    # the rows being pasted are copied out of the eyes:
+    for eye, ((x1, y1, x2, y2), x) in zip(eyes, placements):
+        top = y1 + y
+        bottom = min(y1 + y + rows, y2)
+        if top >= bottom:
+            continue
+        band = eye.crop((x1, top, x2, bottom))
+        dst.paste(band, (x, dst_y))
+        band.close()
+
+def band_rows_for(size):
+    return max(1, default_band_size // (size[0] * 4))
+
+def create_adjusted_image(eyes, adj):
+    '''
+    Applies the adjustments to both eyes of a stereo image and returns a new
+    side by side image (cross-eyed ordering) ready to be saved.
+    '''
+    size, background, placements = adjusted_image_layout(eyes, adj)
+    new_img = Image.new(eyes[0].mode, size, background)
+    band_rows = band_rows_for(size)
+    for y in range(0, size[1], band_rows):
+        paste_adjusted_rows(new_img, y, eyes, placements, y, band_rows)
+    return new_img
+
+def adjusted_image_bands(eyes, adj):
+    '''
+    Yields the adjusted side by side image as successive bands of rows, each
+    as its own image, so that the whole image is never in memory at once.
+    '''
+    size, background, placements = adjusted_image_layout(eyes, adj)
+    band_rows = band_rows_for(size)
+    for y in range(0, size[1], band_rows):
+        rows = min(band_rows, size[1] - y)
+        band = Image.new(eyes[0].mode, (size[0], rows), background)
+        paste_adjusted_rows(band, 0, eyes, placements, y, rows)
+        yield band
+
+def source_info(filename):
+    # Only reads the headers, for the metadata to copy into the output:
+    image = Image.open(filename)
+    try:
+        return dict(image.info)
+    finally:
+        image.close()
+
+def write_adjusted_image(eyes, adj, filename, profile, info):
+    if output_extension(filename).lower() == '.pns' and png_writer.is_supported_mode(eyes[0].mode):
+        # PNG can be written one band at a time:
+        size = adjusted_image_layout(eyes, adj)[0]
+        icc_profile = None
+        if profile.keep_metadata:
+            icc_profile = info.get('icc_profile')
+        with open(filename, 'wb') as f:
+            png_writer.write_png(f, size, eyes[0].mode,
+                    (band.tobytes() for band in adjusted_image_bands(eyes, adj)),
+                    profile.png_compress_level, icc_profile)
+        return
+
+    # Pillow can only encode a complete JPEG, but composing it band by band
+    # at least avoids copying each eye in full before pasting it:
+    new_img = create_adjusted_image(eyes, adj)
+    new_img.save(filename, format='JPEG', **profile.jpeg_options(info))
+    new_img.close()
+
+def export_adjusted_image(eyes, filename, adj, lossless, cache, profile, jpg_filename, spct_filename):
+    # Returns the adjustments that were actually applied, and whether the
+    # image was saved losslessly:
+    if lossless:
+        snapped = lossless_crop.save_lossless(filename, adj, jpg_filename, profile)
+        if snapped is not None:
+            print('Saved %s + %s losslessly' % (jpg_filename, spct_filename))
+            return snapped, True
+
+    print('Saving %s + %s (%s)...' % (jpg_filename, spct_filename, profile.name))
+
+    # Save the adjustments first, so they aren't lost if the export fails:
+    save_spct(spct_filename, filename, adj)
+
+    if eyes is None:
+        eyes = load_stereo_image(filename, cache)
+
+    write_adjusted_image(eyes, adj, jpg_filename, profile, source_info(filename))
+    return adj, False
+
+def save_adjusted_image(eyes, filename, adj, lossless=True, cache=eye_cache,
+        spct_filename=None, previous_export=None):
+    '''
+    Saves an adjusted copy of the stereo image loaded from filename alongside
+    a .spct file that can be used to re-open the original with the same
+    adjustments. Returns the two filenames that were written, which are new
+    unless spct_filename is passed, in which case it and the image saved
+    alongside it are overwritten.
+
+    The .spct file records a hash of the source and of the adjustments the
+    image was exported with, so that it can be skipped if it is exported
+    again without changes (see export_record). previous_export is the record
+    being overwritten, if any, to avoid hashing the source again if it looks
+    unmodified.
+
+    The encoder settings come from the export profile named in adj. If
+    lossless is set, JPEG based images are cropped without re-encoding
+    where possible (see lossless_crop), in which case the .spct records the
+    crop as moved to the MCU boundaries. eyes may be None, in which case they
+    are only decoded (through the cache) if the image has to be re-encoded.
+    '''
+    profile = export_profiles.get_profile(adj.export_profile)
+    if spct_filename is None:
+        jpg_filename, spct_filename = output_filenames(filename)
+        try:
+            saved, saved_lossless = export_adjusted_image(eyes, filename, adj, lossless, cache,
+                    profile, jpg_filename, spct_filename)
+        except:
+            release_output_filenames((jpg_filename, spct_filename))
+            raise
+    else:
+        jpg_filename = paired_output(spct_filename, filename)
+        saved, saved_lossless = export_adjusted_image(eyes, filename, adj, lossless, cache,
+                profile, jpg_filename, spct_filename)
+
+    record = export_record.make_record(filename, saved, profile, saved_lossless, jpg_filename, previous_export)
+    save_spct(spct_filename, filename, saved, record)
+    catalog.record_saved(spct_filename, filename, saved)
+
+    return jpg_filename, spct_filename
+
+# vi:et:sw=4:ts=4
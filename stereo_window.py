@@ -0,0 +1,338 @@
+#!/usr/bin/env python
+
+# Copyright 2016 Ian Munsie
+#
+# This file is part of the Stereo Cropping Tool.
+#
+# The Stereo Cropping Tool is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The Stereo Cropping Tool is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# The Stereo Cropping Tool. If not, see <http://www.gnu.org/licenses/>.
+
+# Checks for stereo window violations: something in front of the window that
+# the crop makes around the image, but cut off by its edge, which is
+# uncomfortable to look at. The disparity is only estimated in narrow strips
+# along the four edges of the crop, which is quick enough to do while the
+# crop is being adjusted.
+#
+# The depth of the left and right edges of the window is set by the crop of
+# each eye (see calc_horizontal_offsets), and the top and bottom edges are
+# taken to lie on the plane between them. A violation is fixed by cropping
+# the edges forwards, as with control + right button in the program:
+#
+#   python stereo_window.py [-j PROCESSES] FILE_OR_DIRECTORY...
+#
+# checks each .spct file (or the most recent .spct file of each image in the
+# directories) and prints the horizontal crop that would fix any violations.
+
+from __future__ import print_function
+
+import sys, os, time, math
+import argparse, itertools, multiprocessing, threading
+from collections import namedtuple
+
+import numpy as np
+
+import stereo_image
+import navigation
+import auto_align
+import disparity
+
+# Width the eyes are reduced to for the check:
+analysis_width = 1024
+
+# Width of the strips along the left and right edges as a fraction of the
+# width, and of the strips along the top and bottom as a fraction of the
+# height:
+strip_width = 0.04
+
+# Extra rows matched above and below each strip so that the blocks along its
+# top and bottom still have a full pyramid to be found with:
+strip_margin = 16
+
+# The nearest part of each strip, ignoring this percentage of it as noise:
+outlier_percentile = 2.0
+
+# Edges where less than this fraction of the strip could be matched can't be
+# checked, e.g. because the vertical alignment is wrong or there isn't enough
+# detail:
+min_coverage = 0.25
+
+# Anything less than this far in front of the window (in percent of the
+# width) is not reported, and corrected crops leave this much room:
+tolerance = 0.05
+
+# Corrected crops are checked again this many times, since cropping further
+# brings new parts of the image up to the edges:
+max_corrections = 3
+
+edges = ('left', 'right', 'top', 'bottom')
+
+# How far behind the window the nearest part of the image along an edge is, as
+# a percentage of the width (negative if it is in front of the window), and
+# the fraction of the strip that could be matched. clearance is None if too
+# little of the strip could be matched:
+EdgeReport = namedtuple('EdgeReport', ['edge', 'clearance', 'coverage'])
+
+def reduce_eyes(eyes, width=analysis_width):
+    return auto_align.reduce_eye(eyes[0], width), auto_align.reduce_eye(eyes[1], width)
+
+def window_disparity(adj):
+    '''
+    Returns the disparity of the left and right edges of the window as a
+    percentage of the width.
+    '''
+    h_offset = adj.calc_horizontal_offsets()
+    h_offset_r = adj.calc_horizontal_offsets(1)
+    return (100.0 * (h_offset[1] - h_offset[0]), 100.0 * (h_offset_r[1] - h_offset_r[0]))
+
+def left_eye_crop(adj, size):
+    '''
+    Returns the crop box of the left eye in pixels of an eye of the given
+    size, as in adjusted_image_layout(), and how many rows lower the same
+    row is in the right eye.
+    '''
+    w, h = size
+    va = adj.vertical_alignment
+    box = (int(round(adj.hcrop[0][0] * w)), int(round((adj.vcrop[0] + max(-va, 0.0)) * h)),
+            int(round(adj.hcrop[0][1] * w)), int(round((adj.vcrop[1] + min(-va, 0.0)) * h)))
+    return box, int(round(va * h))
+
+def strip_clearance(left, right, dy, columns, rows, window, parallax, pool):
+    '''
+    Matches the strip of the left eye between columns and rows against the
+    right eye dy rows lower, and returns the clearance of the nearest part of
+    it behind the window, where window(x) is the disparity of the window at
+    each column, and the fraction that was matched.
+    '''
+    h, w = left.shape
+    max_shift = int(math.ceil(disparity.max_disparity * w))
+    x0, x1 = max(0, columns[0] - max_shift), min(w, columns[1] + max_shift)
+    y0 = max(0, -dy, rows[0] - strip_margin)
+    y1 = min(h, h - dy, rows[1] + strip_margin)
+    if x1 - x0 < 2 or y1 - y0 < 2:
+        return None, 0.0
+
+    found, valid = disparity.block_match(left[y0:y1, x0:x1], right[y0 + dy : y1 + dy, x0:x1],
+            pool, max_shift)
+    strip = (slice(max(0, rows[0] - y0), rows[1] - y0), slice(columns[0] - x0, columns[1] - x0))
+    found, valid = found[strip], valid[strip]
+    coverage = float(valid.mean())
+    if coverage < min_coverage:
+        return None, coverage
+
+    x = np.arange(columns[0], columns[1])[np.newaxis, :]
+    clearance = found * 100.0 / w + parallax - window(x)
+    return float(np.percentile(clearance[valid], outlier_percentile)), coverage
+
+def check(reduced, adj, pool=None):
+    '''
+    Checks the edges of the window made by the adjustments for violations,
+    given the eyes from reduce_eyes(). Returns an EdgeReport for each edge.
+    '''
+    left, right = reduced
+    h, w = left.shape
+    (x0, y0, x1, y1), dy = left_eye_crop(adj, (w, h))
+    sw = min(x1 - x0, max(2 * disparity.block_radius + 1, int(round(strip_width * w))))
+    sh = min(y1 - y0, max(2 * disparity.block_radius + 1, int(round(strip_width * h))))
+
+    window_l, window_r = window_disparity(adj)
+    span = float(max(1, x1 - x0))
+    plane = lambda x: window_l + (window_r - window_l) * (x - x0) / span
+    strips = {
+        'left': ((x0, x0 + sw), (y0, y1), lambda x: window_l),
+        'right': ((x1 - sw, x1), (y0, y1), lambda x: window_r),
+        'top': ((x0, x1), (y0, y0 + sh), plane),
+        'bottom': ((x0, x1), (y1 - sh, y1), plane),
+    }
+
+    reports = []
+    for edge in edges:
+        columns, rows, window = strips[edge]
+        if columns[1] - columns[0] < 1 or rows[1] - rows[0] < 1:
+            reports.append(EdgeReport(edge, None, 0.0))
+            continue
+        reports.append(EdgeReport(edge, *strip_clearance(left, right, dy, columns, rows,
+                window, adj.parallax, pool)))
+    return reports
+
+def violations(reports):
+    return [ r for r in reports if r.clearance is not None and r.clearance < -tolerance ]
+
+def move_window_forwards(hcrop, left, right):
+    '''
+    Returns a copy of hcrop with the left and right edges of the window moved
+    forwards by the given percentages of the width, by cropping each eye in
+    opposite directions, the same as cropping forwards in the program. Once
+    one eye can't be uncropped any further the other eye is cropped by the
+    remainder. Returns None if that would crop away all of either eye.
+    '''
+    hcrop = [list(h) for h in hcrop]
+    if left > 0:
+        amount = left / 100.0
+        uncrop = min(amount / 2.0, hcrop[1][0])
+        hcrop[1][0] -= uncrop
+        hcrop[0][0] += amount - uncrop
+    if right > 0:
+        amount = right / 100.0
+        uncrop = min(amount / 2.0, 1.0 - hcrop[0][1])
+        hcrop[0][1] += uncrop
+        hcrop[1][1] -= amount - uncrop
+    if hcrop[0][0] >= hcrop[0][1] or hcrop[1][0] >= hcrop[1][1]:
+        return None
+    return hcrop
+
+def suggest_hcrop(reduced, adj, reports=None, pool=None):
+    '''
+    Returns the horizontal crop that moves the window in front of everything
+    along its edges, or None if there are no violations or they can't be
+    fixed without cropping away all of either eye. Violations along the top
+    and bottom are fixed by moving both sides of the window forwards. Also
+    returns the reports for the suggested crop, or the original crop if None.
+    '''
+    if reports is None:
+        reports = check(reduced, adj, pool)
+    if not violations(reports):
+        return None, reports
+    original = reports
+    adj = adj.copy()
+    for i in range(max_corrections):
+        needed = dict((r.edge, tolerance - r.clearance) for r in violations(reports))
+        if not needed:
+            break
+        both = max(needed.get('top', 0.0), needed.get('bottom', 0.0))
+        adj.hcrop = move_window_forwards(adj.hcrop, max(needed.get('left', 0.0), both),
+                max(needed.get('right', 0.0), both))
+        if adj.hcrop is None:
+            return None, original
+        reports = check(reduced, adj, pool)
+    return adj.hcrop, reports
+
+def describe(reports):
+    problems = [ '%s edge %.2f%% in front of the window' % (r.edge, -r.clearance)
+            for r in violations(reports) ]
+    if problems:
+        return 'Stereo window violations: %s' % ', '.join(problems)
+    unknown = [ r.edge for r in reports if r.clearance is None ]
+    if len(unknown) == len(reports):
+        return 'Unable to check for stereo window violations'
+    if unknown:
+        return 'No stereo window violations (unable to check the %s edge%s)' % (
+                ', '.join(unknown), 's' if len(unknown) > 1 else '')
+    return 'No stereo window violations'
+
+def describe_hcrop(hcrop):
+    return '[[%.4f, %.4f], [%.4f, %.4f]]' % tuple(hcrop[0] + hcrop[1])
+
+class WindowChecker(object):
+    '''
+    Checks the adjustments being made in the program on a background thread,
+    so that the crop can be dragged without waiting for each check. Only the
+    most recent adjustments are checked, and any made while a check is
+    running replace each other.
+    '''
+    def __init__(self, on_checked=None):
+        self.on_checked = on_checked # Called on the checking thread
+        self.cond = threading.Condition()
+        self.pending = None # (eyes, adjustments) waiting to be checked
+        self.eyes = None    # Eyes that self.reduced was made from
+        self.reduced = None
+        self.thread = threading.Thread(target=self.run, name='WindowChecker')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def check(self, eyes, adj):
+        with self.cond:
+            self.pending = (eyes, adj.copy())
+            self.cond.notify_all()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while self.pending is None:
+                    self.cond.wait()
+                eyes, adj = self.pending
+                self.pending = None
+
+            if eyes is not self.eyes:
+                self.eyes, self.reduced = eyes, reduce_eyes(eyes)
+            reports = check(self.reduced, adj)
+
+            if self.on_checked is not None:
+                self.on_checked(adj, reports)
+
+def check_worker(filename):
+    # Runs in the worker processes, so must not raise:
+    try:
+        source, adj = stereo_image.load_spct(filename)
+        reduced = reduce_eyes(disparity.load_eyes(source, analysis_width))
+        reports = check(reduced, adj)
+        return filename, (reports,) + suggest_hcrop(reduced, adj, reports), None
+    except (IOError, OSError, ValueError, stereo_image.SpctError, stereo_image.UnsupportedImageError) as e:
+        return filename, None, str(e)
+    except Exception as e:
+        # Anything else is a bug, but should only lose this file rather than
+        # the whole run:
+        return filename, None, '%s: %s' % (e.__class__.__name__, str(e))
+
+def parse_args():
+    parser = argparse.ArgumentParser(description = 'Check .spct files for '
+            'stereo window violations along the edges of their crops')
+    parser.add_argument('files', nargs='+', metavar='path',
+            help='.spct files, or directories to search for the most recent '
+            '.spct file of each image')
+    parser.add_argument('-j', '--jobs', type=int, default=multiprocessing.cpu_count(),
+            help='Number of images to check in parallel (default: %(default)s)')
+    return parser.parse_args()
+
+def main():
+    multiprocessing.freeze_support()
+    args = parse_args()
+
+    files = list(itertools.chain(*[ navigation.find_spct_files(path)
+            if os.path.isdir(path) else [path] for path in args.files ]))
+    if args.jobs > 1 and len(files) > 1:
+        pool = multiprocessing.Pool(args.jobs)
+        results = pool.imap(check_worker, files)
+    else:
+        pool = None
+        results = itertools.imap(check_worker, files)
+
+    violated = failed = 0
+    start = time.time()
+    for i, (filename, result, error) in enumerate(results, 1):
+        if error is not None:
+            print('[%i/%i] Unable to check %s: %s' % (i, len(files), filename, error), file=sys.stderr)
+            failed += 1
+            continue
+        reports, hcrop, fixed = result
+        print('[%i/%i] %s: %s' % (i, len(files), filename, describe(reports)))
+        if hcrop is not None:
+            print('    Suggested horizontal_crop: %s%s' % (describe_hcrop(hcrop),
+                '' if not violations(fixed) else ' (%s)' % describe(fixed)))
+        elif violations(reports):
+            print('    Unable to fix by cropping forwards')
+        if violations(reports):
+            violated += 1
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    print('%i checked, %i with violations, %i failed in %.1f seconds' %
+            (len(files) - failed, violated, failed, time.time() - start))
+    if failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
+
+# vi:et:sw=4:ts=4
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+
+# Copyright 2016 Ian Munsie
+#
+# This file is part of the Stereo Cropping Tool.
+#
+# The Stereo Cropping Tool is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The Stereo Cropping Tool is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# The Stereo Cropping Tool. If not, see <http://www.gnu.org/licenses/>.
+
+# Copies images into locked D3DFMT_X8R8G8B8 surfaces. This only deals with
+# memory addresses and never touches Direct3D itself, so it can be run and
+# benchmarked without a device:
+#
+#   python texture_upload.py [WIDTHxHEIGHT]
+
+from __future__ import print_function
+
+import sys, time, ctypes
+import numpy as np
+
+# Images are uploaded in bands of rows of about this many bytes, so the only
+# temporary copy is one band rather than the whole image. Smaller bands use
+# less memory at the cost of more calls into Pillow per image:
+default_band_size = 1024 * 1024
+
+def pitched_rows(address, pitch, row_bytes, height):
+    '''
+    Returns a height x row_bytes numpy view of a surface with rows that are
+    pitch bytes apart. Only row_bytes of the last row are guaranteed to be
+    addressable, so the view is careful not to include the padding after it.
+    '''
+    dst_buf = (ctypes.c_uint8 * (pitch * (height - 1) + row_bytes)).from_address(address)
+    np_dst_buf = np.frombuffer(dst_buf, np.uint8)
+    return np.lib.stride_tricks.as_strided(np_dst_buf,
+            shape=(height, row_bytes), strides=(pitch, 1))
+
+def pitched_pixels(address, pitch, width, height):
+    '''
+    Returns a height x width x 4 numpy view of the pixels of a locked
+    X8R8G8B8 surface.
+    '''
+    np_rows = pitched_rows(address, pitch, width * 4, height)
+    return np.lib.stride_tricks.as_strided(np_rows,
+            shape=(height, width, 4), strides=(pitch, 4, 1))
+
+def upload_image(image, address, pitch, band_size=None):
+    '''
+    Writes an image into a locked X8R8G8B8 surface at address, one band of
+    rows at a time. band_size is the approximate number of bytes per band,
+    or default_band_size if not specified.
+    '''
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    if band_size is None:
+        band_size = default_band_size
+    row_bytes = image.width * 4
+    band_rows = max(1, band_size // row_bytes)
+    if pitch != row_bytes:
+        np_dst_buf = pitched_rows(address, pitch, row_bytes, image.height)
+
+    for y in range(0, image.height, band_rows):
+        rows = min(band_rows, image.height - y)
+        band = image
+        if rows != image.height:
+            band = image.crop((0, y, image.width, y + rows))
+
+        # Pillow can pack its internal pixel buffer straight into the byte
+        # order of the texture in a single pass, which is much faster than
+        # shuffling the channels with numpy and avoids its temporaries:
+        data = band.tobytes('raw', 'BGRX')
+
+        if pitch == row_bytes:
+            ctypes.memmove(address + y * pitch, data, len(data))
+        else:
+            np_dst_buf[y:y + rows] = np.frombuffer(data, np.uint8).reshape(rows, row_bytes)
+
+def legacy_upload_image(image, address, pitch):
+    # The previous implementation, kept for comparison in the benchmark. This
+    # ignores the pitch and makes a 24bpp copy of the image with tobytes(),
+    # then another with the fancy indexing to swap the channels.
+    np_src_buf = np.frombuffer(image.tobytes(), np.uint8).reshape(image.width * image.height, 3)
+    dst_buf = (ctypes.c_uint8 * image.width * image.height * 4).from_address(address)
+    np_dst_buf = np.frombuffer(dst_buf, np.uint8).reshape(image.width * image.height, 4)
+    np_dst_buf[:,:-1] = np_src_buf[:,[2,1,0]]
+
+def benchmark(width, height, repeat=5):
+    from PIL import Image
+
+    print('Generating %ix%i test image...' % (width, height))
+    rows = np.random.randint(0, 256, (height, width * 3)).astype(np.uint8)
+    image = Image.frombytes('RGB', (width, height), rows.tostring())
+    del rows
+    dst = ctypes.create_string_buffer(width * height * 4)
+    address = ctypes.addressof(dst)
+
+    tests = [('legacy', legacy_upload_image, None)]
+    for band_size in (256 * 1024, default_band_size, 4 * 1024 * 1024, 16 * 1024 * 1024, width * height * 4):
+        tests.append(('%i KB bands' % (band_size // 1024), upload_image, band_size))
+
+    reference = None
+    for name, fn, band_size in tests:
+        times = []
+        for i in range(repeat):
+            ctypes.memset(dst, 0, len(dst))
+            start = time.time()
+            if band_size is None:
+                fn(image, address, width * 4)
+            else:
+                fn(image, address, width * 4, band_size)
+            times.append(time.time() - start)
+        print('%-16s best %7.1f ms, mean %7.1f ms' % (name,
+            min(times) * 1000.0, sum(times) / len(times) * 1000.0))
+
+        # The X channel is undefined, so only compare the colour channels:
+        result = np.frombuffer(dst.raw, np.uint8).reshape(-1, 4)[:,:3]
+        if reference is None:
+            reference = result
+        assert((reference == result).all())
+
+if __name__ == '__main__':
+    size = (6000, 4000)
+    if len(sys.argv) > 1:
+        size = map(int, sys.argv[1].split('x'))
+    benchmark(*size)
+
+# vi:et:sw=4:ts=4
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+
+# Copyright 2016 Ian Munsie
+#
+# This file is part of the Stereo Cropping Tool.
+#
+# The Stereo Cropping Tool is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The Stereo Cropping Tool is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# The Stereo Cropping Tool. If not, see <http://www.gnu.org/licenses/>.
+
+# Displays images that are too large for a single texture (e.g. stitched
+# stereo panoramas) as a pyramid of tiles, only uploading the tiles that are
+# visible at the current zoom and pan and evicting the rest. The textures
+# themselves are created through a TileBackend, so the scheduling can be
+# exercised without a device using MemoryTileBackend:
+#
+#   python tiles.py [WIDTHxHEIGHT]
+
+from __future__ import print_function
+
+import sys, math
+from collections import OrderedDict
+
+from PIL import Image
+
+default_tile_size = 512
+default_max_tiles = 256
+
+class TileBackend(object):
+    '''
+    Creates and releases the textures for the tiles of a TiledImage.
+    '''
+    def create_tile(self, image):
+        '''
+        Returns a texture handle for an image, which is at most tile_size
+        pixels in either dimension.
+        '''
+        raise NotImplementedError()
+
+    def release_tile(self, handle):
+        pass
+
+class MemoryTileBackend(TileBackend):
+    '''
+    Keeps tiles in memory instead of on a device, and tracks how many were
+    created and how many bytes are resident.
+    '''
+    def __init__(self):
+        self.created = self.released = 0
+        self.nbytes = self.peak_nbytes = 0
+
+    def create_tile(self, image):
+        self.created += 1
+        self.nbytes += image.width * image.height * 4
+        self.peak_nbytes = max(self.peak_nbytes, self.nbytes)
+        return image.copy()
+
+    def release_tile(self, handle):
+        self.released += 1
+        self.nbytes -= handle.width * handle.height * 4
+
+class TiledImage(object):
+    '''
+    A pyramid of tiles for one eye. Level 0 is the full resolution image, and
+    each level after that is half the size of the previous one, down to the
+    first level that fits in a single tile. At most max_tiles are kept
+    resident, evicting the least recently displayed tiles.
+    '''
+    def __init__(self, image, backend, tile_size=default_tile_size, max_tiles=default_max_tiles):
+        self.backend = backend
+        self.tile_size = tile_size
+        self.max_tiles = max_tiles
+        self.width, self.height = image.size
+        self.levels = [image]
+        while max(self.width, self.height) >> len(self.levels) >= tile_size:
+            self.levels.append(None)
+        self.tiles = OrderedDict() # (level, tx, ty) -> (handle, uv rect)
+
+    @staticmethod
+    def needs_tiling(image, max_width, max_height):
+        return image.width > max_width or image.height > max_height
+
+    def level_image(self, level):
+        # Reduced levels are only generated when they are first displayed:
+        if self.levels[level] is None:
+            prev = self.level_image(level - 1)
+            size = (max(1, prev.width // 2), max(1, prev.height // 2))
+            self.levels[level] = prev.resize(size, Image.BOX)
+        return self.levels[level]
+
+    def level_for_scale(self, scale):
+        # The smallest level that still has at least one texel per pixel:
+        if scale >= 1.0:
+            return 0
+        level = int(math.floor(math.log(1.0 / scale, 2)))
+        return min(level, len(self.levels) - 1)
+
+    def tile_range(self, level, u1, v1, u2, v2):
+        width = max(1, self.width >> level)
+        height = max(1, self.height >> level)
+        tx1 = max(0, int(math.floor(u1 * width / self.tile_size)))
+        ty1 = max(0, int(math.floor(v1 * height / self.tile_size)))
+        tx2 = min((width - 1) // self.tile_size, int(math.ceil(u2 * width / self.tile_size)) - 1)
+        ty2 = min((height - 1) // self.tile_size, int(math.ceil(v2 * height / self.tile_size)) - 1)
+        return [ (tx, ty) for ty in range(ty1, ty2 + 1) for tx in range(tx1, tx2 + 1) ]
+
+    def load_tile(self, key):
+        level, tx, ty = key
+        image = self.level_image(level)
+        x1, y1 = tx * self.tile_size, ty * self.tile_size
+        x2 = min(x1 + self.tile_size, image.width)
+        y2 = min(y1 + self.tile_size, image.height)
+        tile = image.crop((x1, y1, x2, y2))
+        handle = self.backend.create_tile(tile)
+        uv = (float(x1) / image.width, float(y1) / image.height,
+              float(x2) / image.width, float(y2) / image.height)
+        return handle, uv
+
+    def visible_tiles(self, scale, u1, v1, u2, v2):
+        '''
+        Returns a list of (handle, (u1, v1, u2, v2)) for the tiles covering
+        the given region of the image in texture coordinates, when displayed
+        at scale. Tiles that are not yet resident are created, and the least
+        recently used tiles beyond max_tiles are released, though never any
+        that are being returned.
+        '''
+        level = self.level_for_scale(scale)
+        result = []
+        keys = set()
+        for tx, ty in self.tile_range(level, u1, v1, u2, v2):
+            key = (level, tx, ty)
+            entry = self.tiles.pop(key, None)
+            if entry is None:
+                entry = self.load_tile(key)
+            self.tiles[key] = entry
+            keys.add(key)
+            result.append(entry)
+
+        for key in list(self.tiles.keys()):
+            if len(self.tiles) <= self.max_tiles:
+                break
+            if key not in keys:
+                self.backend.release_tile(self.tiles.pop(key)[0])
+
+        return result
+
+    def release(self):
+        for handle, uv in self.tiles.values():
+            self.backend.release_tile(handle)
+        self.tiles.clear()
+
+def simulate(width, height, view=(1920, 1080)):
+    import time
+
+    print('Generating %ix%i test image...' % (width, height))
+    image = Image.new('RGB', (width, height), (128, 128, 128))
+    backend = MemoryTileBackend()
+    tiled = TiledImage(image, backend, max_tiles=64)
+
+    fit = min(float(view[0]) / width, float(view[1]) / height)
+    steps = [ (fit, 0.5, 0.5) ]
+    # Zoom in on the middle, then pan across the image at 100%:
+    for scale in (fit * 2, fit * 4, 0.5, 1.0):
+        steps.append((scale, 0.5, 0.5))
+    for x in range(11):
+        steps.append((1.0, x / 10.0, 0.5))
+    steps.append((fit, 0.5, 0.5))
+
+    start = time.time()
+    for scale, cx, cy in steps:
+        hw = view[0] / 2.0 / scale / width
+        hh = view[1] / 2.0 / scale / height
+        tiles = tiled.visible_tiles(scale, max(0, cx - hw), max(0, cy - hh), min(1, cx + hw), min(1, cy + hh))
+        print('scale %.3f centre (%.1f, %.1f): level %i, %i tiles visible, %i resident, %.1f MB' %
+                (scale, cx, cy, tiled.level_for_scale(scale), len(tiles), len(tiled.tiles),
+                 backend.nbytes / 1048576.0))
+    print('%i tiles created, %i released, peak %.1f MB resident in %.1f seconds' % (backend.created,
+        backend.released, backend.peak_nbytes / 1048576.0, time.time() - start))
+
+if __name__ == '__main__':
+    size = (20000, 5000)
+    if len(sys.argv) > 1:
+        size = map(int, sys.argv[1].split('x'))
+    simulate(*size)
+
+# vi:et:sw=4:ts=4